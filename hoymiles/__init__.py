@@ -5,10 +5,19 @@
 Hoymiles micro-inverters python shared code
 """
 import sys
+import time
+from binascii import hexlify
 
 HOYMILES_DEBUG_LOGGING = False  # ok global
 HOYMILES_TRANSACTION_LOGGING = False  # ok global
 
+if sys.implementation.name == "micropython":
+    def ticks_ms(): return time.ticks_ms()
+    def ticks_diff(new, old): return time.ticks_diff(new, old)
+else:
+    def ticks_ms(): return int(time.monotonic() * 1000)
+    def ticks_diff(new, old): return new - old
+
 
 def hexify_payload(byte_var):  # global
     """
@@ -18,7 +27,7 @@ def hexify_payload(byte_var):  # global
     :return: two-byte while-space padded byte representation
     :rtype: str
     """
-    return ' '.join([f"{b:02x}" for b in byte_var])
+    return hexlify(byte_var, ' ').decode()
 
 
 _attrs = {"HoymilesDTU": "dtu"}
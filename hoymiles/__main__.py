@@ -8,6 +8,7 @@ Hoymiles micro-inverters main application
 import sys
 import time
 import hoymiles
+import hoymiles.log as log
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -25,6 +26,12 @@ if sys.platform == 'linux':
         if mqtt_client:
             mqtt_client.disco()
 
+        for aggregator in aggregators.values():
+            aggregator.flush()
+
+        if dtu:
+            dtu.save_state(force=True)
+
         if influx_client:
             influx_client.disco()
 
@@ -46,6 +53,7 @@ def init_logging(ahoy_config):
     lvl = logging.ERROR
     max_log_filesize = 1000000
     max_log_files = 1
+    ring_size = 0
     if log_config:
         fn = log_config.get('filename', fn)
         level = log_config.get('level', 'ERROR')
@@ -61,11 +69,13 @@ def init_logging(ahoy_config):
             lvl = logging.FATAL
         max_log_filesize = log_config.get('max_log_filesize', max_log_filesize)
         max_log_files = log_config.get('max_log_files', max_log_files)
+        ring_size = log_config.get('ring', ring_size)
     if hoymiles.HOYMILES_TRANSACTION_LOGGING:
         lvl = logging.DEBUG
     logging.basicConfig(handlers=[RotatingFileHandler(fn, maxBytes=max_log_filesize, backupCount=max_log_files)],
                         format='%(asctime)s %(levelname)s: %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S.%s', level=lvl)
+    log.configure(lvl, ring_size=ring_size)  # hot path logging of the hoymiles modules
     dtu_name = ahoy_config.get('dtu', {}).get('name', 'hoymiles-dtu')
     logging.info(f'start logging for {dtu_name} with level: {logging.getLevelName(logging.root.level)}')
 
@@ -75,6 +85,10 @@ def init_logging(ahoy_config):
 mqtt_client = None
 influx_client = None
 volkszaehler_client = None
+prometheus_client = None
+web_data = None
+dtu = None
+aggregators = {}  # output name -> Aggregator, downsampling stage of time-series outputs
 
 event_message_index = {}
 command_queue = {}
@@ -82,15 +96,26 @@ command_queue = {}
 mqtt_command_topic_subs = []  # todo used by mqtt_on_command
 
 
-def status_callback(result, inverter):
+def init_dispatcher():
+    """ Register output plugins, every output gets its own queue and worker """
+    from hoymiles.dispatcher import OutputDispatcher
+    dispatcher = OutputDispatcher()
     if mqtt_client:
-        mqtt_client.store_status(result, topic=inverter.get('mqtt', {}).get('topic', None))
-
+        dispatcher.add('mqtt',
+                       lambda result, inverter: mqtt_client.store_status(result, topic=inverter.get('mqtt', {}).get('topic', None)))
     if influx_client:
-        influx_client.store_status(result)
-
+        # points are written in batches by a background thread of the influx client
+        influx_store = aggregators.get('influx', influx_client).store_status
+        dispatcher.add('influx', lambda result, inverter: influx_store(result))
     if volkszaehler_client:
-        volkszaehler_client.store_status(result)
+        volkszaehler_store = aggregators.get('volkszaehler', volkszaehler_client).store_status
+        dispatcher.add('volkszaehler', lambda result, inverter: volkszaehler_store(result), thread=True)
+    if prometheus_client:
+        dispatcher.add('prometheus', lambda result, inverter: prometheus_client.store_status(result), policy='latest')
+    if web_data:
+        dispatcher.add('web', lambda result, inverter: web_data.store_status(result),
+                       size=max(len(web_data.inverters), 1))  # keep the result of every inverter
+    return dispatcher
 
 
 def info_callback(result, inverter):
@@ -153,7 +178,11 @@ if __name__ == '__main__':
             influx_config.get('token'),
             org=influx_config.get('org', ''),
             bucket=influx_config.get('bucket', None),
-            measurement=influx_config.get('measurement', 'hoymiles'))
+            measurement=influx_config.get('measurement', 'hoymiles'),
+            batch_size=influx_config.get('batch_size', 500),
+            flush_interval=influx_config.get('flush_interval', 10000),
+            gzip=influx_config.get('gzip', True),
+            spool=influx_config.get('spool', None))
 
     # create VOLKSZAEHLER - client object
     volkszaehler_config = ahoy_config.get('volkszaehler', {})
@@ -162,6 +191,29 @@ if __name__ == '__main__':
 
         volkszaehler_client = VolkszaehlerOutputPlugin(volkszaehler_config)
 
+    # create PROMETHEUS - exporter object
+    prometheus_config = ahoy_config.get('prometheus', {})
+    if prometheus_config and not prometheus_config.get('disabled', False):
+        from .outputs import PrometheusOutputPlugin
+
+        prometheus_client = PrometheusOutputPlugin(prometheus_config)
+
+    # create WEB - server object (same server as on Micropython)
+    web_config = ahoy_config.get('web', {})
+    web_server = None
+    if web_config and not web_config.get('disabled', False):
+        from hoymiles.webdata import WebPlugin
+        from hoymiles.uwebserver import WebServer
+
+        web_data = WebPlugin(ahoy_config.get('inverters', []), history=web_config.get('history'))
+        web_server = WebServer(data_provider=web_data,
+                               start_page=web_config.get('start_page'),
+                               static_dir=web_config.get('static_dir', 'www'),
+                               host=web_config.get('host', '0.0.0.0'),
+                               port=web_config.get('port', 8080),
+                               max_clients=web_config.get('max_clients', 8),
+                               max_event_clients=web_config.get('max_event_clients', 4))
+
     for g_inverter in ahoy_config.get('inverters', []):
         g_inverter_ser = g_inverter.get('serial')
 
@@ -174,13 +226,50 @@ if __name__ == '__main__':
             mqtt_client.client.subscribe(topic_item[1])
             mqtt_command_topic_subs.append(topic_item)
 
+    # optional downsampling, one record per window to the time-series outputs
+    from hoymiles.aggregator import Aggregator
+    if influx_client and influx_config.get('aggregate'):
+        aggregators['influx'] = Aggregator(influx_client.store_status, window=influx_config.get('aggregate'))
+    if volkszaehler_client and volkszaehler_config.get('aggregate'):
+        aggregators['volkszaehler'] = Aggregator(volkszaehler_client.store_status,
+                                                 window=volkszaehler_config.get('aggregate'))
+
+    output_dispatcher = init_dispatcher()
+
     # start main-loop
     dtu = hoymiles.HoymilesDTU(ahoy_config,
                                mqtt_client,          # optional if no sunset support
                                event_message_index,  # pass only if need in global context
                                command_queue,        # pass only if need in global context
-                               status_handler=status_callback,
+                               status_handler=output_dispatcher.dispatch,
                                info_handler=info_callback)
+
+    spools = {name: client.spool for name, client in (('mqtt', mqtt_client), ('influx', influx_client))
+              if client and client.spool}
+    if volkszaehler_client:
+        spools.update({f'volkszaehler/{serial}': output.spool
+                       for serial, output in volkszaehler_client.inverters.items() if output.spool})
+    if prometheus_client:
+        prometheus_client.add_health('dtu', lambda: dtu.stats)
+        prometheus_client.add_health('output', output_dispatcher.metrics, label='output')
+        if spools:
+            prometheus_client.add_health('spool', lambda: {name: spool.metrics() for name, spool in spools.items()},
+                                         label='output')
+    if web_data:
+        web_data.add_health('dtu', lambda: dtu.stats)
+        web_data.add_health('output', output_dispatcher.metrics)
+        web_data.add_health('web', web_server.metrics)
+        if spools:
+            web_data.add_health('spool', lambda: {name: spool.metrics() for name, spool in spools.items()})
+
+    async def main():
+        output_dispatcher.start()
+        if prometheus_client:
+            asyncio.create_task(prometheus_client.serve())
+        if web_server:
+            asyncio.create_task(web_server.webserver())
+        await dtu.start()
+
     import asyncio
-    asyncio.run(dtu.start())
+    asyncio.run(main())
     # main_loop(ahoy_config)  # mqtt_client, influx_client, volkszaehler_client, event_message_index, command_queue
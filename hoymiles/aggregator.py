@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Downsampling stage for time-series outputs
+
+Collects the results of each inverter over a time window and hands one aggregated
+record per window to the output. Measured values are averaged (with min/max),
+counters (energy, event count) keep their last value and AC power is integrated
+into energy.
+"""
+
+from datetime import datetime, timezone
+from hoymiles.decoders import StatusResponse
+
+# counters, the last value of the window is kept
+LAST_KEYS = ('energy_total', 'energy_daily', 'yield_total', 'yield_today', 'event_count')
+
+
+class AggregatedResponse(StatusResponse):
+    """
+    Aggregated StatusResponse of a window
+
+    to_dict() has the layout of StatusResponse.to_dict(), averaged values get
+    additional '<key>_min' and '<key>_max' entries, phases an 'energy' entry (Wh
+    within the window). 'samples' and 'window' describe the aggregation.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.inverter_ser = data.get('inverter_ser')
+        self.inverter_name = data.get('inverter_name')
+        self.dtu_ser = data.get('dtu_ser')
+        self.time_rx = data.get('time')
+
+    def to_dict(self):
+        return self.data
+
+
+class _Window:
+    def __init__(self, start):
+        self.start = start
+        self.samples = 0
+        self.stats = {}      # (group, index, key) -> [min, max, sum, count, last]
+        self.energy = []     # Wh per phase
+        self.last = None     # last data dict
+
+    def add(self, data):
+        self.samples += 1
+        self.last = data
+        for group in ('phases', 'strings'):
+            for index, values in enumerate(data.get(group) or []):
+                for key, value in values.items():
+                    self._add((group, index, key), value)
+        for key, value in data.items():
+            self._add((None, None, key), value)
+
+    def _add(self, slot, value):
+        if value is None or value is True or value is False or not isinstance(value, (int, float)):
+            return
+        stat = self.stats.get(slot)
+        if stat is None:
+            self.stats[slot] = [value, value, value, 1, value]
+            return
+        if value < stat[0]:
+            stat[0] = value
+        if value > stat[1]:
+            stat[1] = value
+        stat[2] += value
+        stat[3] += 1
+        stat[4] = value
+
+    def result(self, window):
+        data = dict(self.last)
+        data['phases'] = [dict(phase) for phase in self.last.get('phases') or []]
+        data['strings'] = [dict(string) for string in self.last.get('strings') or []]
+        for (group, index, key), (v_min, v_max, v_sum, count, v_last) in self.stats.items():
+            values = data if group is None else data[group][index] if index < len(data[group]) else None
+            if values is None or key in ('inverter_ser', 'dtu_ser'):
+                continue
+            if key in LAST_KEYS:
+                values[key] = v_last
+            else:
+                values[key] = v_sum / count
+                values[f'{key}_min'] = v_min
+                values[f'{key}_max'] = v_max
+        for phase, energy in zip(data['phases'], self.energy):
+            phase['energy'] = energy
+        data['time'] = datetime.fromtimestamp(self.start, timezone.utc)
+        data['samples'] = self.samples
+        data['window'] = window
+        return data
+
+
+class Aggregator:
+    """
+    Aggregate results per inverter over fixed, aligned time windows.
+
+    Usage::
+
+        aggregator = Aggregator(influx_client.store_status, window=60)
+        dispatcher.add('influx', lambda result, inverter: aggregator.store_status(result))
+    """
+
+    def __init__(self, handler, window=60, max_gap=None):
+        """
+        :param handler: callable(response) called with an AggregatedResponse per window
+        :param int window: window length in seconds
+        :param int max_gap: do not integrate power over gaps longer than max_gap seconds (default: window)
+        """
+        self.handler = handler
+        self.window = window
+        self.max_gap = max_gap if max_gap else window
+        self.windows = {}    # inverter serial -> _Window
+        self.previous = {}   # inverter serial -> (timestamp, ac powers) of the last sample
+        self.received = 0
+        self.emitted = 0
+
+    def store_status(self, response, **params):
+        """
+        Add StatusResponse object, emits the previous window of the inverter if a new one starts
+
+        :param hoymiles.decoders.StatusResponse response: StatusResponse object
+        """
+        if not isinstance(response, StatusResponse):
+            return
+
+        data = response.to_dict()
+        if data is None or not isinstance(data.get('time'), datetime):
+            return
+        self.received += 1
+
+        serial = data['inverter_ser']
+        ts = data['time'].timestamp()
+        start = ts - ts % self.window
+
+        current = self.windows.get(serial)
+        if current is not None and current.start != start:
+            self._emit(serial)
+            current = None
+        if current is None:
+            current = self.windows[serial] = _Window(start)
+
+        powers = [phase.get('power') or 0 for phase in data.get('phases') or []]
+        previous = self.previous.get(serial)
+        if previous is not None and 0 < ts - previous[0] <= self.max_gap:
+            dt = ts - previous[0]
+            while len(current.energy) < len(powers):
+                current.energy.append(0.0)
+            for phase_id, (p_prev, p) in enumerate(zip(previous[1], powers)):
+                current.energy[phase_id] += (p_prev + p) / 2 * dt / 3600  # trapezoid, Wh
+        self.previous[serial] = (ts, powers)
+
+        current.add(data)
+
+    def flush(self):
+        """Emit all open windows (e.g. on shutdown)"""
+        for serial in list(self.windows):
+            self._emit(serial)
+
+    def _emit(self, serial):
+        current = self.windows.pop(serial)
+        if current.samples:
+            self.emitted += 1
+            self.handler(AggregatedResponse(current.result(self.window)))
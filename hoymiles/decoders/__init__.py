@@ -14,13 +14,23 @@ try:
     from crcmod import mkCrcFun
 except ImportError:
     from .ucrcmod import mkCrcFun
-import logging
+import hoymiles.log as log
 
 #f_crc_m = crcmod.predefined.mkPredefinedCrcFun('modbus')
 #f_crc8 = crcmod.mkCrcFun(0x101, initCrc=0, xorOut=0)
 f_crc_m = mkCrcFun(0x18005, initCrc=0xffff, xorOut=0)  # simplified to use minimal crc mod
 f_crc8 = mkCrcFun(0x101, initCrc=0, xorOut=0)
 
+ALARM_ENTRY_SIZE = 12  # bytes per alarm log entry
+
+try:
+    _iter_unpack = struct.iter_unpack
+except AttributeError:  # micropython
+    def _iter_unpack(fmt, buffer):
+        size = struct.calcsize(fmt)
+        for offset in range(0, len(buffer), size):
+            yield struct.unpack_from(fmt, buffer, offset)
+
 
 class ResponseDecoderFactory:
     """
@@ -170,7 +180,7 @@ class ResponseDecoder(ResponseDecoderFactory):
 
             else:
                 model_desc = "event not configured - check ahoy script"
-            logging.info(f'model_decoder: {model}Decode{command.upper()} - {model_desc}')
+            log.info('model_decoder: %sDecode%s - %s', model, command.upper(), model_desc)
 
         model_decoders = __import__('hoymiles.decoders').decoders  # fix lazy import of model decoders
         if hasattr(model_decoders, f'{model}Decode{command.upper()}'):
@@ -218,14 +228,17 @@ def print_table_unpack(s_fmt, payload, cw=6):
     :return: None
     """
 
+    if not log.enabled(log.DEBUG):
+        return
+
     l_hexlified = [f'{byte:02x}' for byte in payload]
 
     dbg  = f'{"Pos": <{cw}}'
     dbg += ''.join([f'{num: >{cw}}' for num in range(0, len(payload))])
-    logging.debug(dbg)
+    log.debug(dbg)
     dbg  = f'{"Hex": <{cw}}'
     dbg += ''.join([f'{byte: >{cw}}' for byte in l_hexlified])
-    logging.debug(dbg)
+    log.debug(dbg)
 
     l_fmt = struct.calcsize(s_fmt)
     if len(payload) >= l_fmt:
@@ -233,7 +246,7 @@ def print_table_unpack(s_fmt, payload, cw=6):
             dbg  = f'{s_fmt: <{cw}}'
             dbg += ' ' * cw * offset
             dbg += ''.join([f'{num[0]: >{cw*l_fmt}}' for num in g_unpack(s_fmt, payload[offset:])])
-            logging.debug(dbg)
+            log.debug(dbg)
 
 
 class Response:
@@ -290,7 +303,7 @@ class StatusResponse(Response):
         size = struct.calcsize(fmt)
         if len(self.response) < base+size:
             self.unpack_error = True
-            logging.error(f'base: {base} size: {size} len: {len(self.response)} fmt: {fmt} rep: {self.response}')
+            log.error('base: %s size: %s len: %s fmt: %s rep: %s', base, size, len(self.response), fmt, self.response)
             return [0]
         return struct.unpack(fmt, self.response[base:base+size])
 
@@ -510,26 +523,42 @@ class EventsResponse(UnknownResponse):
 
         self.status = struct.unpack('>H', self.response[:2])[0]
         self.a_text = self.alarm_codes.get(self.status, 'N/A')
-        logging.info (f'Inverter status: {self.a_text} ({self.status})')
-
-        chunk_size = 12
-        for i_chunk in range(2, len(self.response), chunk_size):
-            chunk = self.response[i_chunk:i_chunk+chunk_size]
+        self.new = None  # number of new alarms at the end of the log, None: all
+        log.info('Inverter status: %s (%s)', self.a_text, self.status)
 
-            logging.debug(' '.join([f'{byte:02x}' for byte in chunk]) + ': ')
+        if log.enabled(log.DEBUG):
+            for opcode, a_code, a_count, start, end in self.alarms():
+                log.debug(' start=%s end=%s a_count=%s opcode=%s a_code=%s a_text=%s',
+                          timedelta(seconds=start), timedelta(seconds=end), a_count, opcode, a_code,
+                          self.alarm_codes.get(a_code, 'N/A'))
 
-            if len(chunk[0:6]) < 6:
-                logging.error(f'length of chunk must be greater or equal 6 bytes: {chunk}')
-                return
+    def alarms(self):
+        """
+        Yield alarm records of the log, oldest first
 
-            opcode, a_code, a_count, uptime_sec = struct.unpack('>BBHH', chunk[0:6])
-            a_text = self.alarm_codes.get(a_code, 'N/A')
-            logging.debug(f' uptime={timedelta(seconds=uptime_sec)} a_count={a_count} opcode={opcode} a_code={a_code} a_text={a_text}')
+        :return: opcode, alarm code (key of alarm_codes), count, start, end
+                 (seconds of the inverter 12h clock, pm flags of opcode applied)
+        :rtype: tuple
+        """
+        entries = memoryview(self.response)[2:]
+        entries = entries[:len(entries) - len(entries) % ALARM_ENTRY_SIZE]
+        for opcode, a_code, a_count, start, end, _, _ in _iter_unpack('>BBHHHHH', entries):
+            if opcode & 0x20:
+                start += 43200
+            if opcode & 0x10:
+                end += 43200
+            yield opcode, a_code, a_count, start, end
+
+    def new_alarms(self):
+        """
+        Alarm records not seen before (see new)
 
-            dbg = ''
-            for fmt in ['BBHHHHH']:
-                dbg += f' {fmt:7}: ' + str(struct.unpack('>' + fmt, chunk))
-            logging.debug(dbg)
+        :rtype: list
+        """
+        records = list(self.alarms())
+        if self.new is None:
+            return records
+        return records[max(len(records) - self.new, 0):] if self.new > 0 else []
 
     def to_dict(self):
         """ Base values, availabe in each to_dict call """
@@ -537,6 +566,9 @@ class EventsResponse(UnknownResponse):
         data = super().to_dict()
         data['inv_stat_num'] = self.status
         data['inv_stat_txt'] = self.a_text
+        data['alarms'] = [{'code': a_code, 'text': self.alarm_codes.get(a_code, 'N/A'), 'count': a_count,
+                           'start': start, 'end': end}
+                          for _, a_code, a_count, start, end in self.new_alarms()]
         return data
 
 
@@ -563,11 +595,12 @@ class HardwareInfoResponse(UnknownResponse):
         data = super().to_dict()
 
         if len(self.response) != 16:
-            logging.error(f'HardwareInfoResponse: data length should be 16 bytes - measured {len(self.response)} bytes')
-            logging.error(f'HardwareInfoResponse: data: {self.response}')
+            log.error('HardwareInfoResponse: data length should be 16 bytes - measured %s bytes', len(self.response))
+            log.error('HardwareInfoResponse: data: %s', self.response)
             return data
 
-        logging.info(f'HardwareInfoResponse: {struct.unpack(">HHHHHHHH", self.response[0:16])}')
+        if log.enabled(log.INFO):
+            log.info('HardwareInfoResponse: %s', struct.unpack('>HHHHHHHH', self.response[0:16]))
         fw_version, fw_build_yyyy, fw_build_mmdd, fw_build_hhmm, hw_id = struct.unpack('>HHHHH', self.response[0:10])
 
         fw_version_maj = int((fw_version / 10000))
@@ -577,9 +610,9 @@ class HardwareInfoResponse(UnknownResponse):
         fw_build_dd = int(fw_build_mmdd % 100)
         fw_build_HH = int(fw_build_hhmm / 100)
         fw_build_MM = int(fw_build_hhmm % 100)
-        logging.info(f'Firmware: {fw_version_maj}.{fw_version_min}.{fw_version_pat} ' +
-                     f'build at {fw_build_dd:>02}/{fw_build_mm:>02}/{fw_build_yyyy}T{fw_build_HH:>02}:{fw_build_MM:>02}, ' +
-                     f'HW revision {hw_id}')
+        log.info('Firmware: %d.%d.%d build at %02d/%02d/%dT%02d:%02d, HW revision %s',
+                 fw_version_maj, fw_version_min, fw_version_pat, fw_build_dd, fw_build_mm, fw_build_yyyy,
+                 fw_build_HH, fw_build_MM, hw_id)
 
         data['FW_ver_maj'] = fw_version_maj
         data['FW_ver_min'] = fw_version_min
@@ -601,40 +634,42 @@ class DebugDecodeAny(UnknownResponse):
 
         crc8_valid = self.validate_crc8()
         if crc8_valid:
-            logging.debug(' payload has valid crc8')
+            log.debug(' payload has valid crc8')
             self.response = self.response[:-1]
 
         crc_valid = self.validate_crc_m()
         if crc_valid:
-            logging.debug(' payload has valid modbus crc')
+            log.debug(' payload has valid modbus crc')
             self.response = self.response[:-2]
 
-        l_payload = len(self.response)
-        logging.debug(f' payload has {l_payload} bytes')
+        if not log.enabled(log.DEBUG):  # tables of unknown payloads are debug output only
+            return
+
+        log.debug(' payload has %s bytes', len(self.response))
 
-        logging.debug('')
-        logging.debug('Field view: int')
+        log.debug('')
+        log.debug('Field view: int')
         print_table_unpack('>B', self.response)
 
-        logging.debug('')
-        logging.debug('Field view: shorts')
+        log.debug('')
+        log.debug('Field view: shorts')
         print_table_unpack('>H', self.response)
 
-        logging.debug('')
-        logging.debug('Field view: longs')
+        log.debug('')
+        log.debug('Field view: longs')
         print_table_unpack('>L', self.response)
 
         try:
             if len(self.response) > 2:
-                logging.debug(' type utf-8  : ' + self.response.decode('utf-8'))
+                log.debug(' type utf-8  : %s', self.response.decode('utf-8'))
         except UnicodeDecodeError:
-            logging.debug(' type utf-8  : utf-8 decode error')
+            log.debug(' type utf-8  : utf-8 decode error')
 
         try:
             if len(self.response) > 2:
-                logging.debug(' type ascii  : ' + self.response.decode('ascii'))
+                log.debug(' type ascii  : %s', self.response.decode('ascii'))
         except UnicodeDecodeError:
-            logging.debug(' type ascii  : ascii decode error')
+            log.debug(' type ascii  : ascii decode error')
 
 
 # 1121-Series Intervers, 1 MPPT, 1 Phase
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Output fan-out dispatcher (CPython and Micropython)
+
+Decouples output plugins from the radio loop: dispatch() only enqueues the decoded
+result, every output (sink) is served by its own worker task and bounded queue.
+"""
+
+import sys
+import asyncio
+
+from hoymiles import ticks_ms, ticks_diff
+import hoymiles.log as log
+
+POLICY_FIFO = 'fifo'      # keep every item up to queue size, drop oldest on overflow (time series)
+POLICY_LATEST = 'latest'  # keep only the newest item (display, web)
+
+
+class Sink:
+    """Bounded queue and metrics of a single output"""
+
+    def __init__(self, name, handler, policy=POLICY_FIFO, size=8, thread=False):
+        """
+        :param str name: name of the output (used for metrics)
+        :param handler: callable(result, inverter), may be a coroutine function
+        :param str policy: 'fifo' or 'latest'
+        :param int size: maximum queue size (policy 'fifo' only)
+        :param bool thread: call blocking handler in a worker thread (CPython only)
+        """
+        self.name = name
+        self.handler = handler
+        self.policy = policy
+        self.size = 1 if policy == POLICY_LATEST else size
+        self.thread = thread and sys.implementation.name != "micropython"
+        self.queue = []
+        self.event = asyncio.Event()
+        # metrics
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_ms = 0
+        self.max_latency_ms = 0
+
+    def put(self, item):
+        if len(self.queue) >= self.size:
+            self.queue.pop(0)
+            self.dropped += 1
+        self.queue.append(item)
+        self.event.set()
+
+    async def worker(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            while self.queue:
+                result, inverter, t_enqueued = self.queue.pop(0)
+                try:
+                    if self.thread:
+                        await asyncio.to_thread(self.handler, result, inverter)
+                    else:
+                        ret = self.handler(result, inverter)
+                        if ret is not None and hasattr(ret, 'send'):  # coroutine
+                            await ret
+                    self.delivered += 1
+                except Exception as e:
+                    self.errors += 1
+                    log.warning('output %s failed: %s', self.name, e)
+                self.latency_ms = ticks_diff(ticks_ms(), t_enqueued)
+                if self.latency_ms > self.max_latency_ms:
+                    self.max_latency_ms = self.latency_ms
+                await asyncio.sleep(0)
+
+    def metrics(self):
+        return {'depth': len(self.queue), 'delivered': self.delivered, 'dropped': self.dropped,
+                'errors': self.errors, 'latency_ms': self.latency_ms, 'max_latency_ms': self.max_latency_ms}
+
+
+class OutputDispatcher:
+    """
+    Fan out decoded results to output plugins.
+
+    Usage::
+
+        dispatcher = OutputDispatcher()
+        dispatcher.add('display', lambda result, inverter: display.store_status(result), policy='latest')
+        dispatcher.add('influx', lambda result, inverter: influx.store_status(result), thread=True)
+        dtu = HoymilesDTU(ahoy_cfg, status_handler=dispatcher.dispatch)
+        dispatcher.start()  # within running event loop
+    """
+
+    def __init__(self):
+        self.sinks = []
+
+    def add(self, name, handler, policy=POLICY_FIFO, size=8, thread=False):
+        """
+        Register output
+
+        :return: created sink
+        :rtype: Sink
+        """
+        sink = Sink(name, handler, policy=policy, size=size, thread=thread)
+        self.sinks.append(sink)
+        return sink
+
+    def start(self):
+        """Create one worker task per sink"""
+        for sink in self.sinks:
+            asyncio.create_task(sink.worker())
+
+    def dispatch(self, result, inverter):
+        """Enqueue result for all sinks, never blocks (use as status_handler/info_handler of HoymilesDTU)"""
+        t_enqueued = ticks_ms()
+        for sink in self.sinks:
+            sink.put((result, inverter, t_enqueued))
+
+    def metrics(self):
+        """
+        Queue depth, delivered/dropped items, errors and latency (enqueue to handled) per sink
+
+        :rtype: dict
+        """
+        return {sink.name: sink.metrics() for sink in self.sinks}
@@ -8,12 +8,12 @@ import sys
 import time
 import asyncio
 import struct
-import logging
 from datetime import datetime, timezone
 
-from hoymiles import HOYMILES_DEBUG_LOGGING, HOYMILES_TRANSACTION_LOGGING, hexify_payload
+from hoymiles import HOYMILES_DEBUG_LOGGING, HOYMILES_TRANSACTION_LOGGING, hexify_payload, ticks_ms, ticks_diff
+import hoymiles.log as log
 
-from hoymiles.decoders import StatusResponse, HardwareInfoResponse, ResponseDecoder, f_crc8, f_crc_m  # todo move f_crc_m , f_crc8 to global
+from hoymiles.decoders import StatusResponse, HardwareInfoResponse, EventsResponse, ResponseDecoder, f_crc8, f_crc_m  # todo move f_crc_m , f_crc8 to global
 
 if sys.implementation.name != "micropython":
     def const(x): return x
@@ -264,6 +264,7 @@ class InverterTransaction:
         if not request_time:
             request_time = datetime.now(timezone.utc)
 
+        self.crc_errors = 0
         self.scratch = []
         if 'scratch' in params:
             self.scratch = params['scratch']
@@ -310,17 +311,18 @@ class InverterTransaction:
                         time_rx=datetime.now(timezone.utc)
                         )
                 if HOYMILES_TRANSACTION_LOGGING:
-                    logging.debug(response)
+                    log.debug('%s', response)
 
                 self.frame_append(response)
                 wait = True
         except OSError:  # jk was TimeoutError now OSError(ETIMEDOUT) thrown from module
             pass
         except HMBufferError as e:  # jk BufferError not supported
-            logging.warning(f'Buffer error {e}')
+            self.crc_errors += 1
+            log.warning('Buffer error %s', e)
             pass
         except Exception as e:  # jk new block
-            logging.warning(f'Exception {e}')
+            log.warning('Exception %s', e)
             pass
 
         return wait
@@ -494,20 +496,97 @@ class HoymilesDTU:
             self.sunset = SunsetHandler(sunset_cfg, self.event_handler)
 
         self.loop_interval = ahoy_cfg.get('interval', 2)
+        self.poll_interval = None
+        adaptive_cfg = ahoy_cfg.get('adaptive_interval')
+        if adaptive_cfg and not adaptive_cfg.get('disabled', False):
+            if (sunset_cfg and not sunset_cfg.get('disabled', False)
+                    and sunset_cfg.get('latitude') is not None and sunset_cfg.get('longitude') is not None):
+                # scale interval with sun elevation (requires sun_moon.py)
+                from .pollinterval import SolarPollInterval
+                self.poll_interval = SolarPollInterval(adaptive_cfg, sunset_cfg['latitude'], sunset_cfg['longitude'])
+            else:
+                log.warning('adaptive_interval requires an enabled sunset config with latitude and longitude, '
+                            'polling every %s s', self.loop_interval)
         self.transmit_retries = ahoy_cfg.get('transmit_retries', 5)
         if self.transmit_retries <= 0:
-            logging.critical('Parameter "transmit_retries" must be >0 - please check ahoy.yml.')
+            log.critical('Parameter "transmit_retries" must be >0 - please check ahoy.yml.')
             # print message to console too
             print('Parameter "transmit_retries" must be >0 - please check ahoy.yml - STOP(0)x')
             sys.exit(0)
 
+        # night detection from inverter silence, complements (or replaces) the sunset handler
+        night_cfg = ahoy_cfg.get('night_detection', {})
+        self.night_detection = bool(night_cfg) and not night_cfg.get('disabled', False)
+        self.night_silence = night_cfg.get('silence', 900)          # seconds without response of any inverter
+        self.night_power = night_cfg.get('power_threshold', 20)     # W, last ac power of the fleet below
+        self.night_probe_interval = night_cfg.get('probe_interval', 600)  # seconds between probes (1 try per inverter)
+        self.night = False
+        self.t_response = time.time()  # last response of any inverter
+        self.fleet_power = {}          # inverter serial -> ac power of the last response
+        self.event_count = {}          # inverter serial -> event count of the last StatusResponse
+
+        # health counters, poll_latency_ms of the last inverter poll
+        self.stats = {'polls': 0, 'timeouts': 0, 'retries': 0, 'crc_errors': 0, 'poll_latency_ms': 0}
+
+        # optional persistent state, restarts without re-requesting hardware info and processed alarms
+        self.state = None
+        state_cfg = ahoy_cfg.get('state')
+        if state_cfg and not state_cfg.get('disabled', False):
+            from .statestore import StateStore
+            self.attach_state(StateStore(state_cfg.get('path', 'dtu_state.bin'), interval=state_cfg.get('interval', 600)))
+
+    def attach_state(self, store):
+        """
+        Restore event message index, pending commands, radio channels and statistics from store and keep them there
+
+        :param hoymiles.statestore.StateStore store: state store
+        """
+        self.state = store
+        if not store.load():
+            return
+        for key, value in store.stats.items():
+            self.stats[key] = value
+        if self.hmradio and store.channels[0] is not None:
+            self.hmradio.tx_channel_id, self.hmradio.rx_channel_id = store.channels
+        for serial, inverter_state in store.inverters.items():
+            self.event_message_index[serial] = inverter_state.event_index
+            if inverter_state.commands:  # composed again, the stored requests hold no time stamp
+                self.command_queue[serial] = [compose_send_time_payload(command[0],
+                                                                        alarm_id=struct.unpack('>H', command[1:3])[0])
+                                              for command in inverter_state.commands]
+
+    def save_state(self, force=False):
+        """
+        Write state if changed, at most every interval seconds of the store
+
+        :param bool force: write now (e.g. before sleep or shutdown), statistics included
+        """
+        store = self.state
+        if store is None:
+            return
+        for serial, queue in self.command_queue.items():
+            inverter_state = store.inverter(serial)
+            commands = [payload[0:1] + payload[8:10] for payload in queue]  # command id, alarm id
+            if inverter_state.commands != commands:
+                inverter_state.commands = commands
+                store.changed()
+        store.stats = self.stats
+        if self.hmradio:
+            store.channels = (self.hmradio.tx_channel_id, self.hmradio.rx_channel_id)
+        if force:
+            store.changed()
+        store.save(force)
+
     async def start(self):
         try:
             do_init = True
             while True:
 
                 if self.sunset:
+                    t_wait = time.time()
                     await self.sunset.checkWaitForSunrise()
+                    if time.time() - t_wait > 1:  # slept until sunrise
+                        self._reset_night()
 
                 t_loop_start = time.time()
 
@@ -515,29 +594,74 @@ class HoymilesDTU:
                     if 'name' not in inverter:
                         inverter['name'] = 'hoymiles'
                     if 'serial' not in inverter:
-                        logging.error("No inverter serial number found in ahoy.yml - exit")
+                        log.error("No inverter serial number found in ahoy.yml - exit")
                         sys.exit(999)
                     if HOYMILES_DEBUG_LOGGING:
-                        logging.info(f'Poll inverter name={inverter["name"]} ser={inverter["serial"]}')
+                        log.info('Poll inverter name=%s ser=%s', inverter['name'], inverter['serial'])
+                    t_poll = ticks_ms()
+                    self.stats['polls'] += 1
                     try:
                         self.event_handler({'event_type': 'inverter.polling'})
                         await asyncio.wait_for(self.poll_inverter(inverter, do_init), timeout=self.transmit_retries+5)
                     except asyncio.TimeoutError as e:
-                        print("t", end="")
+                        self.stats['timeouts'] += 1
+                        log.debug('poll %s: timeout', inverter['name'])
                         # self.event_handler({'event_type': 'inverter.timeout'})
+                    self.stats['poll_latency_ms'] = ticks_diff(ticks_ms(), t_poll)
                 do_init = False
-
-                if self.loop_interval > 0:
-                    time_to_sleep = self.loop_interval - (time.time() - t_loop_start)
+                self.save_state()
+
+                if self.night_detection:
+                    self._check_night()
+                if self.night:
+                    loop_interval = self.night_probe_interval
+                elif self.poll_interval:
+                    loop_interval = self.poll_interval.interval()
+                else:
+                    loop_interval = self.loop_interval
+                if loop_interval > 0:
+                    time_to_sleep = loop_interval - (time.time() - t_loop_start)
                     if time_to_sleep > 0:
                         await asyncio.sleep(time_to_sleep)
                 await asyncio.sleep(0.1)  # 0.1 ok ohne inverter
 
         except Exception as e:
-            logging.error('Exception catched: %s' % e)
-            #logging.fatal(traceback.print_exc())
+            log.error('Exception catched: %s', e)
             raise e
 
+    def _check_night(self):
+        # silence of all inverters after production ramped down: probe with low duty until first response
+        # (events without sunrise/sunset, the times of the sunset handler stay valid)
+        if self.night or time.time() - self.t_response < self.night_silence:
+            return
+        if sum(self.fleet_power.values()) >= self.night_power:
+            return  # no ramp down, radio problem
+        self.night = True
+        log.info('No response from inverters, night detected')
+        self.event_handler({'event_type': 'suntimes.sleeping', 'sleeping_time': self.night_probe_interval})
+
+    def _set_event_index(self, inv_str, index):
+        # index of the last processed alarm, persisted (a restart must not publish alarms again)
+        self.event_message_index[inv_str] = index
+        if self.state:
+            self.state.inverter(inv_str).event_index = index
+            self.state.changed()
+
+    def _reset_night(self):
+        # after the sleep of the sunset handler: silence and power of the last evening are stale
+        # (the sunset handler sent the wakeup event)
+        self.night = False
+        self.t_response = time.time()
+        self.fleet_power.clear()
+
+    def _on_response(self, inverter_ser, data):
+        self.t_response = time.time()
+        self.fleet_power[inverter_ser] = sum(phase.get('power') or 0 for phase in data.get('phases') or [])
+        if self.night:
+            self.night = False
+            log.info('Inverter responded, night is over')
+            self.event_handler({'event_type': 'suntimes.wakeup', 'sleeping_time': self.night_probe_interval})
+
     async def poll_inverter(self, inverter, do_init):
         """
         Send/Receive command_queue, initiate status poll on inverter
@@ -549,25 +673,33 @@ class HoymilesDTU:
 
         # Queue at least status data request
         inv_str = str(inverter_ser)
-        # print(f"polling inverter {inverter_name}", end="")
-        print("p", end="")  # todo remove debug
+        log.debug('poll %s', inverter_name)
         if do_init:
             if not self.command_queue.get(inv_str):
                 self.command_queue[inv_str] = []       # initialize map for inverter
-                self.event_message_index[inv_str] = 0  # initialize map for inverter
-            self.command_queue[inv_str].append(compose_send_time_payload(InverterDevInform_All))
+                self.event_message_index.setdefault(inv_str, 0)  # initialize map for inverter (unless restored)
+            hardware_info = self.state.inverter(inv_str).hardware_info if self.state else None
+            if not hardware_info:
+                self.command_queue[inv_str].append(compose_send_time_payload(InverterDevInform_All))
+            elif self.info_handler:  # restored, published once instead of requested again
+                self.info_handler(HardwareInfoResponse(hardware_info, inverter_ser=inverter_ser,
+                                                       inverter_name=inverter_name, dtu_ser=self.dtu_ser), inverter)
             # self.command_queue[inv_str].append(compose_send_time_payload(SystemConfigPara))
         self.command_queue[inv_str].append(compose_send_time_payload(RealTimeRunData_Debug))
 
         # Put all queued commands for current inverter on air
         while len(self.command_queue[inv_str]) > 0:
             payload = self.command_queue[inv_str].pop(0)  # Sub.Cmd
-            print("q", end="")  # todo remove debug
+            log.debug('request 0x%02x', payload[0])
 
-            # Send payload {ttl}-times until we get at least one reponse
-            payload_ttl = self.transmit_retries
+            # Send payload {ttl}-times until we get at least one reponse, probe once at night
+            transmit_retries = 1 if self.night else self.transmit_retries
+            payload_ttl = transmit_retries
             response = None
             while payload_ttl > 0:
+                if payload_ttl < transmit_retries:
+                    self.stats['retries'] += 1
+                    log.debug('retry %d', transmit_retries - payload_ttl)
                 payload_ttl = payload_ttl - 1
                 com = InverterTransaction(
                     radio=self.hmradio,
@@ -581,18 +713,19 @@ class HoymilesDTU:
                         response = com.get_payload()
                         payload_ttl = 0
                     except Exception as e_all:
+                        if isinstance(e_all, ValueError):  # payload crc
+                            self.stats['crc_errors'] += 1
                         if HOYMILES_TRANSACTION_LOGGING:
-                            logging.error(f'Error while retrieving data: {e_all}')
+                            log.error('Error while retrieving data: %s', e_all)
                         pass
                     await asyncio.sleep(0.001)
+                self.stats['crc_errors'] += com.crc_errors
                 await asyncio.sleep(0.1)
-                print(".", end="")  # todo remove debug
 
             # Handle the response data if any
             if response:
-                print("")  # todo remove debug
-                if HOYMILES_TRANSACTION_LOGGING:
-                    logging.debug(f'Payload: ' + hexify_payload(response))
+                if HOYMILES_TRANSACTION_LOGGING and log.enabled(log.DEBUG):
+                    log.debug('Payload: %s', hexify_payload(response))
 
                 # prepare decoder object
                 decoder = ResponseDecoder(response,
@@ -605,17 +738,24 @@ class HoymilesDTU:
 
                 # get decoder object
                 result = decoder.decode()
-                if HOYMILES_DEBUG_LOGGING:
-                    logging.info(f'Decoded: {result.to_dict()}')
+                if HOYMILES_DEBUG_LOGGING and log.enabled(log.INFO):
+                    log.info('Decoded: %s', result.to_dict())
 
                 # check decoder object for output
                 if isinstance(result, StatusResponse):
 
                     data = result.to_dict()
+                    if data is not None:
+                        self._on_response(inv_str, data)
+                    if data is not None and self.poll_interval:
+                        self.poll_interval.update(inv_str, self.fleet_power[inv_str])
                     if data is not None and 'event_count' in data:
-                        event_count = data['event_count']
-                        if self.event_message_index[inv_str] < event_count:
-                            self.event_message_index[inv_str] = event_count
+                        event_count = self.event_count[inv_str] = data['event_count']
+                        if event_count < self.event_message_index[inv_str]:  # inverter restarted, new log
+                            self._set_event_index(inv_str, 0)
+                        # fetch the alarm log once, the index is advanced with the EventsResponse
+                        if self.event_message_index[inv_str] < event_count and \
+                                not any(cmd[0] == AlarmData for cmd in self.command_queue[inv_str]):
                             self.command_queue[inv_str].append(compose_send_time_payload(AlarmData,
                                                                                          alarm_id=event_count))
 
@@ -629,7 +769,19 @@ class HoymilesDTU:
                         else:
                             self.status_handler(result, inverter)
 
+                # publish only alarms not seen before (event index of the last EventsResponse)
+                if isinstance(result, EventsResponse) and inv_str in self.event_count:
+                    event_count = self.event_count[inv_str]
+                    result.new = max(event_count - self.event_message_index[inv_str], 0)
+                    if result.new:
+                        self._set_event_index(inv_str, event_count)
+                        if self.info_handler:
+                            self.info_handler(result, inverter)
+
                 # check decoder object for output
                 if isinstance(result, HardwareInfoResponse):
+                    if self.state:
+                        self.state.inverter(inv_str).hardware_info = bytes(result.response)
+                        self.state.changed()
                     if self.info_handler:
                         self.info_handler(result, inverter)
@@ -0,0 +1,149 @@
+"""
+Fixed size in-RAM history of key values (CPython and Micropython)
+"""
+
+from array import array
+
+NO_DATA = -32768  # slot without samples (e.g. night)
+
+
+class History:
+    """
+    Ring buffers of averaged values, one int16 delta array per key.
+
+    All memory is allocated once in the constructor (2 bytes per value, 24h at
+    interval 60 of an inverter with one string: 11.5 KB). Values are stored as
+    fixed point (value * scale) deltas to the previous slot, exact for changes
+    up to 32767 units per slot (32 kW for power). A slot covers interval seconds.
+
+    Binary format of header() and chunks()::
+
+        {"keys": [...], "scale": [...], "interval": 60, "count": n, "end": ts, "first": [...]}\\n
+        n int16 deltas (little endian) of the first key, oldest first
+        n int16 deltas of the next key ...
+
+    first is the fixed point level before the oldest slot of each key, value i
+    is (first + sum of deltas 0 ... i) / scale, deltas of -32768 mark slots without
+    data (level unchanged). end is the unix time the newest slot ends, value i
+    covers end - (n - i) * interval ... end - (n - i - 1) * interval.
+    """
+
+    def __init__(self, strings=1, size=1440, interval=60):
+        """
+        :param int strings: number of dc strings (one dc power buffer per string)
+        :param int size: number of slots (default 24h at interval 60)
+        :param int interval: seconds per slot
+        """
+        self.keys = ['ac_power'] + [f'dc_power{i}' for i in range(strings)] + ['yield_today', 'temperature']
+        self.scale = [1] * (2 + strings) + [10]  # power in W, yield in Wh, temperature in 0.1 degree
+        self.size = size
+        self.interval = interval
+        self.buffers = [array('h', bytes(2 * size)) for _ in self.keys]
+        self.first = array('l', [0] * len(self.keys))  # level before the oldest slot
+        self.last = array('l', [0] * len(self.keys))   # level of the newest slot
+        self.head = 0       # next slot to write
+        self.count = 0      # used slots
+        self.slot = None    # time slot (timestamp // interval) of the open accumulation
+        self._sum = array('f', bytes(4 * len(self.keys)))
+        self._n = 0
+
+    def add(self, data):
+        """
+        Add decoded StatusResponse data, samples within one slot are averaged
+
+        :param dict data: StatusResponse.to_dict()
+        """
+        timestamp = data.get('time')
+        if timestamp is None:
+            return
+        slot = int(timestamp.timestamp()) // self.interval
+        if self.slot is not None and slot != self.slot:
+            self._close(slot)
+        self.slot = slot
+
+        phases = data.get('phases') or []
+        strings = data.get('strings') or []
+        values = [sum(phase.get('power') or 0 for phase in phases)]
+        for i in range(len(self.keys) - 3):
+            values.append(strings[i].get('power') or 0 if i < len(strings) else 0)
+        values.append(data.get('yield_today') or 0)
+        values.append(data.get('temperature') or 0)
+        for i, value in enumerate(values):
+            self._sum[i] += value
+        self._n += 1
+
+    def _close(self, next_slot):
+        # write average of the open slot, mark skipped slots (max. size) as without data
+        values = []
+        for i in range(len(self.keys)):
+            values.append(round(self._sum[i] / self._n * self.scale[i]))
+            self._sum[i] = 0.0
+        self._n = 0
+        self._write(values)
+        for _ in range(min(next_slot - self.slot - 1, self.size)):
+            self._write(None)
+
+    def _write(self, values):
+        # write fixed point values (None: no data) to the head slot, the oldest slot is merged into first
+        full = self.count == self.size
+        for i, buf in enumerate(self.buffers):
+            if full and buf[self.head] != NO_DATA:
+                self.first[i] += buf[self.head]
+            if values is None:
+                buf[self.head] = NO_DATA
+                continue
+            if not self.count:  # start at the first value
+                self.first[i] = self.last[i] = values[i]
+            delta = max(-32767, min(32767, values[i] - self.last[i]))
+            buf[self.head] = delta
+            self.last[i] += delta
+        self.head = (self.head + 1) % self.size
+        if not full:
+            self.count += 1
+
+    def header(self):
+        """
+        Describe the buffers (json line)
+
+        :rtype: str
+        """
+        end = (self.slot or 0) * self.interval  # start of the open (not yet written) slot
+        keys = ','.join(f'"{key}"' for key in self.keys)
+        scale = ','.join(str(s) for s in self.scale)
+        first = ','.join(str(f) for f in self.first)
+        return (f'{{"keys":[{keys}],"scale":[{scale}],"interval":{self.interval},"count":{self.count},'
+                f'"end":{end},"first":[{first}]}}\n')
+
+    def chunks(self):
+        """
+        Yield memoryviews of the buffers, oldest first (no copies)
+        """
+        for i in range(len(self.buffers)):
+            yield from self._chunks(i)
+
+    def values(self, key):
+        """
+        Decode the values of key, oldest first (None: no data)
+
+        :param str key: one of keys
+        :rtype: list
+        """
+        i = self.keys.index(key)
+        level = self.first[i]
+        values = []
+        for chunk in self._chunks(i):
+            for delta in chunk:
+                if delta == NO_DATA:
+                    values.append(None)
+                else:
+                    level += delta
+                    values.append(level / self.scale[i])
+        return values
+
+    def _chunks(self, i):
+        # memoryviews of buffer i, oldest first
+        start = (self.head - self.count) % self.size
+        mv = memoryview(self.buffers[i])
+        if start + self.count <= self.size:
+            return [mv[start:start + self.count]]
+        return [mv[start:], mv[:self.head]]
@@ -0,0 +1,95 @@
+"""
+Compact JSON serializer writing into a reusable, preallocated buffer (CPython and Micropython)
+"""
+
+from datetime import datetime
+from math import isfinite
+
+
+class JsonWriter:
+    """
+    Serialize decoded inverter data without building intermediate objects.
+
+    The output buffer is allocated once and grows only if a document does not fit.
+    Each call to dump() overwrites the previous document.
+    """
+
+    def __init__(self, size=512):
+        """
+        :param int size: initial buffer size in bytes
+        """
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def dump(self, obj):
+        """
+        Serialize obj into the internal buffer
+
+        :param obj: dict, list, str, number, bool, None or datetime (nan and inf as null)
+        :return: view of the serialized document (valid until next call to dump)
+        :rtype: memoryview
+        """
+        self.pos = 0
+        self._value(obj)
+        return memoryview(self.buf)[:self.pos]
+
+    def dumps(self, obj):
+        """
+        Serialize obj
+
+        :return: serialized document
+        :rtype: bytes
+        """
+        return bytes(self.dump(obj))
+
+    def _write(self, b):
+        end = self.pos + len(b)
+        if end > len(self.buf):
+            self.buf.extend(bytes(max(end - len(self.buf), len(self.buf))))
+        self.buf[self.pos:end] = b
+        self.pos = end
+
+    def _str(self, s):
+        if '"' in s or '\\' in s:
+            s = s.replace('\\', '\\\\').replace('"', '\\"')
+        self._write(b'"')
+        self._write(s.encode())
+        self._write(b'"')
+
+    def _value(self, v):
+        if v is None:
+            self._write(b'null')
+        elif v is True:
+            self._write(b'true')
+        elif v is False:
+            self._write(b'false')
+        elif isinstance(v, float) and not isfinite(v):
+            self._write(b'null')  # nan and inf are not valid json
+        elif isinstance(v, (int, float)):
+            self._write(str(v).encode())
+        elif isinstance(v, str):
+            self._str(v)
+        elif isinstance(v, dict):
+            self._write(b'{')
+            first = True
+            for key in v:
+                if not first:
+                    self._write(b',')
+                first = False
+                self._str(key)
+                self._write(b':')
+                self._value(v[key])
+            self._write(b'}')
+        elif isinstance(v, (list, tuple)):
+            self._write(b'[')
+            first = True
+            for item in v:
+                if not first:
+                    self._write(b',')
+                first = False
+                self._value(item)
+            self._write(b']')
+        elif isinstance(v, datetime):
+            self._str(v.isoformat().split('.')[0])
+        else:
+            self._str(str(v))
@@ -0,0 +1,144 @@
+"""
+Minimal logging for the hot paths (CPython and Micropython)
+
+Replaces the logging module on Micropython (RAM at import). Messages are
+formatted with % only if their level is enabled, expensive arguments are
+guarded with enabled(). Lines are kept in an optional ring buffer in RAM
+(web page /log), printed on Micropython and passed to the logging module on
+CPython (handlers and file rotation of the logging config keep working).
+
+Levels below BUILD_LEVEL are compiled out: set it to INFO for production
+builds and debug() is an empty function on Micropython and CPython.
+
+Usage::
+
+    import hoymiles.log as log
+    log.configure(log.INFO, ring_size=32)
+    log.debug('payload %s bytes', len(payload))  # not formatted at level INFO
+    if log.enabled(log.DEBUG):
+        log.debug('payload %s', hexify_payload(payload))
+"""
+
+import sys
+import time
+
+if sys.implementation.name != "micropython":
+    def const(x): return x
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+CRITICAL = const(50)
+
+BUILD_LEVEL = const(10)  # levels below are compiled out
+
+_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR', CRITICAL: 'CRITICAL'}
+
+level = WARNING
+ring = None    # Ring of the last lines (optional)
+echo = True    # print (Micropython) or pass to logging (CPython)
+
+if sys.implementation.name == "micropython":
+    def _echo(lvl, msg):
+        print(_NAMES[lvl], msg)
+
+    def _print_exception(e):
+        sys.print_exception(e)
+else:
+    import logging
+
+    def _echo(lvl, msg):
+        logging.log(lvl, msg)
+
+    def _print_exception(e):
+        logging.error('Traceback', exc_info=e)
+
+
+class Ring:
+    """Last size log lines, oldest first"""
+
+    def __init__(self, size=32):
+        self.lines = [None] * size
+        self.head = 0
+        self.count = 0
+
+    def append(self, line):
+        self.lines[self.head] = line
+        self.head = (self.head + 1) % len(self.lines)
+        if self.count < len(self.lines):
+            self.count += 1
+
+    def __iter__(self):
+        size = len(self.lines)
+        for i in range(self.head - self.count, self.head):
+            yield self.lines[i % size]
+
+
+def configure(lvl=None, ring_size=None, echo_lines=None):
+    """
+    :param lvl: minimum level to log (int or name, e.g. 'INFO')
+    :param int ring_size: number of lines kept in RAM (0: no ring buffer)
+    :param bool echo_lines: print (Micropython) or pass to logging (CPython)
+    """
+    global level, ring, echo
+    if isinstance(lvl, str):
+        lvl = {name: num for num, name in _NAMES.items()}.get(lvl.upper(), WARNING)
+    if lvl is not None:
+        level = max(lvl, BUILD_LEVEL)
+    if ring_size is not None:
+        ring = Ring(ring_size) if ring_size else None
+    if echo_lines is not None:
+        echo = echo_lines
+
+
+def enabled(lvl):
+    return lvl >= level
+
+
+def _log(lvl, msg, args):
+    if args:
+        msg = msg % args
+    if ring is not None:
+        ring.append(f'{int(time.time())} {_NAMES[lvl]} {msg}')
+    if echo:
+        _echo(lvl, msg)
+
+
+if BUILD_LEVEL > DEBUG:
+    def debug(msg, *args):
+        pass
+else:
+    def debug(msg, *args):
+        if level <= DEBUG:
+            _log(DEBUG, msg, args)
+
+
+if BUILD_LEVEL > INFO:
+    def info(msg, *args):
+        pass
+else:
+    def info(msg, *args):
+        if level <= INFO:
+            _log(INFO, msg, args)
+
+
+def warning(msg, *args):
+    if level <= WARNING:
+        _log(WARNING, msg, args)
+
+
+def error(msg, *args):
+    if level <= ERROR:
+        _log(ERROR, msg, args)
+
+
+def critical(msg, *args):
+    _log(CRITICAL, msg, args)
+
+
+def exception(e):
+    """Log exception e with traceback"""
+    _log(ERROR, '%s', (e,))
+    if echo:
+        _print_exception(e)
@@ -5,11 +5,14 @@
 Hoymiles output plugin library
 """
 
+import json
 import socket
+import asyncio
 import logging
 from datetime import datetime, timezone
-from hoymiles.decoders import StatusResponse, HardwareInfoResponse
+from hoymiles.decoders import StatusResponse, HardwareInfoResponse, EventsResponse
 from hoymiles import HOYMILES_DEBUG_LOGGING
+from hoymiles.spool import Spool, pack_message, unpack_message
 
 class OutputPluginFactory:
     def __init__(self, **params):
@@ -37,6 +40,15 @@ class InfluxOutputPlugin(OutputPluginFactory):
     """ Influx2 output plugin """
     api = None
 
+    # (field id, type tag, value format) of the line protocol templates
+    phase_fields = (('voltage', 'voltage', ''), ('current', 'current', ''), ('power', 'power', ''),
+                    ('reactive_power', 'Q_AC', ''), ('frequency', 'frequency', '.3f'))
+    string_fields = (('voltage', 'voltage', '.3f'), ('current', 'current', '3f'), ('power', 'power', '.2f'),
+                     ('energy_daily', 'YieldDay', '.2f'), ('energy_total', 'YieldTotal', '.4f'),
+                     ('irradiation', 'Irradiation', '.2f'))
+    global_types = {'event_count': 'total_events', 'powerfactor': 'PF_AC', 'temperature': 'Temp',
+                    'yield_total': 'YieldTotal', 'yield_today': 'YieldToday', 'efficiency': 'Efficiency'}
+
     def __init__(self, url, token, **params):
         """
         Initialize InfluxOutputPlugin
@@ -45,6 +57,8 @@ class InfluxOutputPlugin(OutputPluginFactory):
         The following targets must be present in your InfluxDB. This does not
         automatically create anything for You.
 
+        Points of all inverters are collected and written in batches in the background.
+
         :param str url: The url to connect this client to. Like http://localhost:8086
         :param str token: Influx2 access token which is allowed to write to bucket
         :param org: Influx2 org, the token belongs to
@@ -53,11 +67,19 @@ class InfluxOutputPlugin(OutputPluginFactory):
         :type bucket: str
         :param measurement: Default measurement-prefix to use
         :type measurement: str
+        :param batch_size: number of points written at once (default: 500)
+        :type batch_size: int
+        :param flush_interval: maximum time in ms points are kept before writing (default: 10000)
+        :type flush_interval: int
+        :param gzip: compress requests (default: True)
+        :type gzip: bool
+        :param spool: spool config, keep points which could not be written after all retries
+        :type spool: dict or None
         """
         super().__init__(**params)
 
         try:
-            from influxdb_client import InfluxDBClient
+            from influxdb_client import InfluxDBClient, WriteOptions
         except ModuleNotFoundError:
             ErrorText1 = f'Module "influxdb_client" for INFLUXDB necessary.'
             ErrorText2 = f'Install module with command: python3 -m pip install influxdb_client'
@@ -69,14 +91,85 @@ class InfluxOutputPlugin(OutputPluginFactory):
         self._bucket = params.get('bucket', 'hoymiles/autogen')
         self._org = params.get('org', '')
         self._measurement = params.get('measurement', f'inverter,host={socket.gethostname()}')
-
-        with InfluxDBClient(url, token, bucket=self._bucket) as self.client:
-             self.api = self.client.write_api()
+        self._templates = {}
+
+        # optional store-and-forward spool for database outages
+        self.spool = None
+        self._failed = []     # batches failed after all retries (appended by the write api thread)
+        self._healthy = True  # last batch written successfully
+        spool_config = params.get('spool')
+        if spool_config:
+            self.replay_rate = spool_config.get('replay_rate', 500)  # points replayed per poll
+            self.spool = Spool(spool_config.get('path', 'spool/influx'),
+                               segment_size=spool_config.get('segment_size', 65536),
+                               max_segments=spool_config.get('max_segments', 64))
+
+        self.client = InfluxDBClient(url, token, org=self._org, enable_gzip=params.get('gzip', True))
+        self.api = self.client.write_api(write_options=WriteOptions(batch_size=params.get('batch_size', 500),
+                                                                    flush_interval=params.get('flush_interval', 10_000),
+                                                                    retry_interval=5_000,
+                                                                    max_retries=5,
+                                                                    max_retry_delay=125_000,
+                                                                    exponential_base=2),
+                                         success_callback=self._on_success,
+                                         error_callback=self._on_error)
+
+    def _on_success(self, conf, data):
+        self._healthy = True
+
+    def _on_error(self, conf, data, exception):
+        self._healthy = False
+        logging.warning(f'InfluxDB: write failed: {exception}')
+        if self.spool:
+            self._failed.append(data)
+
+    def _replay(self, record):
+        self.api.write(self._bucket, self._org, record.decode())
+        return True
 
     def disco(self, **params):
+        self.api.close()             # flush pending points
         self.client.close()          # Shutdown the client
+        if self.spool:
+            self._spool_failed()
+            self.spool.flush()
         return
 
+    def _spool_failed(self):
+        while self._failed:
+            batch = self._failed.pop(0)
+            for line in (batch.encode() if isinstance(batch, str) else batch).split(b'\n'):
+                if line:
+                    self.spool.append(line)
+
+    def templates(self, data):
+        """
+        Get line protocol prefixes of an inverter, built once when the inverter is first seen
+
+        :param dict data: decoded StatusResponse data
+        :return: prefixes up to the value keyed by field id
+        :rtype: dict
+        """
+        templates = self._templates.get(data['inverter_ser'])
+        if templates is None:
+            measurement = self._measurement + f',location={data["inverter_ser"]}'
+            templates = {'phases': [], 'strings': []}
+            for field_id in self.global_types:
+                templates[field_id] = f'{measurement},type={self.global_types[field_id]} value='
+            templates['measurement'] = measurement
+            self._templates[data['inverter_ser']] = templates
+
+        measurement = templates['measurement']
+        while len(templates['phases']) < len(data['phases']):
+            phase_id = len(templates['phases'])
+            templates['phases'].append(tuple((field_id, f'{measurement},phase={phase_id},type={tag} value=', fmt)
+                                             for field_id, tag, fmt in self.phase_fields))
+        while len(templates['strings']) < len(data['strings']):
+            string_id = len(templates['strings'])
+            templates['strings'].append(tuple((field_id, f'{measurement},string={string_id},type={tag} value=', fmt)
+                                              for field_id, tag, fmt in self.string_fields))
+        return templates
+
     def store_status(self, response, **params):
         """
         Publish StatusResponse object
@@ -92,67 +185,90 @@ class InfluxOutputPlugin(OutputPluginFactory):
         if not isinstance(response, StatusResponse):
             raise ValueError('Data needs to be instance of StatusResponse')
 
-        data = response.to_dict()
+        if self.spool:
+            self._spool_failed()
+            if self._healthy and self.spool.depth:
+                self.spool.replay(self._replay, self.replay_rate)
 
-        measurement = self._measurement + f',location={data["inverter_ser"]}'
+        data = response.to_dict()
+        templates = self.templates(data)
 
         data_stack = []
 
-        time_rx = datetime.now()
+        time_rx = datetime.now(timezone.utc)
         if 'time' in data and isinstance(data['time'], datetime):
             time_rx = data['time']
 
-        # InfluxDB uses UTC
-        utctime = datetime.fromtimestamp(time_rx.timestamp(), tz=timezone.utc)
-
-        # InfluxDB requires nanoseconds
-        ctime = int(utctime.timestamp() * 1e9)
+        # InfluxDB uses UTC and requires nanoseconds
+        ctime = f' {int(time_rx.timestamp() * 1e9)}'
 
         if HOYMILES_DEBUG_LOGGING:
-            logging.info(f'InfluxDB: utctime: {utctime}')
+            logging.info(f'InfluxDB: utctime: {time_rx}')
 
         # AC Data
-        phase_id = 0
-        for phase in data['phases']:
-            data_stack.append(f'{measurement},phase={phase_id},type=voltage value={phase["voltage"]} {ctime}')
-            data_stack.append(f'{measurement},phase={phase_id},type=current value={phase["current"]} {ctime}')
-            data_stack.append(f'{measurement},phase={phase_id},type=power value={phase["power"]} {ctime}')
-            data_stack.append(f'{measurement},phase={phase_id},type=Q_AC value={phase["reactive_power"]} {ctime}')
-            data_stack.append(f'{measurement},phase={phase_id},type=frequency value={phase["frequency"]:.3f} {ctime}')
-            phase_id = phase_id + 1
+        for phase, phase_templates in zip(data['phases'], templates['phases']):
+            for field_id, prefix, fmt in phase_templates:
+                data_stack.append(prefix + format(phase[field_id], fmt) + ctime)
 
         # DC Data
-        string_id = 0
-        for string in data['strings']:
-            data_stack.append(f'{measurement},string={string_id},type=voltage value={string["voltage"]:.3f} {ctime}')
-            data_stack.append(f'{measurement},string={string_id},type=current value={string["current"]:3f} {ctime}')
-            data_stack.append(f'{measurement},string={string_id},type=power value={string["power"]:.2f} {ctime}')
-            data_stack.append(f'{measurement},string={string_id},type=YieldDay value={string["energy_daily"]:.2f} {ctime}')
-            data_stack.append(f'{measurement},string={string_id},type=YieldTotal value={string["energy_total"]/1000:.4f} {ctime}')
-            data_stack.append(f'{measurement},string={string_id},type=Irradiation value={string["irradiation"]:.2f} {ctime}')
-            string_id = string_id + 1
+        for string, string_templates in zip(data['strings'], templates['strings']):
+            for field_id, prefix, fmt in string_templates:
+                value = string[field_id] / 1000 if field_id == 'energy_total' else string[field_id]
+                data_stack.append(prefix + format(value, fmt) + ctime)
 
         # Global
         if data['event_count'] is not None:
-            data_stack.append(f'{measurement},type=total_events value={data["event_count"]} {ctime}')
+            data_stack.append(templates['event_count'] + str(data['event_count']) + ctime)
         if data['powerfactor'] is not None:
-            data_stack.append(f'{measurement},type=PF_AC value={data["powerfactor"]:f} {ctime}')
-        data_stack.append(f'{measurement},type=Temp value={data["temperature"]:.2f} {ctime}')
+            data_stack.append(templates['powerfactor'] + format(data['powerfactor'], 'f') + ctime)
+        data_stack.append(templates['temperature'] + format(data['temperature'], '.2f') + ctime)
         if data['yield_total'] is not None:
-            data_stack.append(f'{measurement},type=YieldTotal value={data["yield_total"]/1000:.3f} {ctime}')
+            data_stack.append(templates['yield_total'] + format(data['yield_total'] / 1000, '.3f') + ctime)
         if data['yield_today'] is not None:
-            data_stack.append(f'{measurement},type=YieldToday value={data["yield_today"]/1000:.3f} {ctime}')
-        data_stack.append(f'{measurement},type=Efficiency value={data["efficiency"]:.2f} {ctime}')
+            data_stack.append(templates['yield_today'] + format(data['yield_today'] / 1000, '.3f') + ctime)
+        data_stack.append(templates['efficiency'] + format(data['efficiency'], '.2f') + ctime)
 
-        if HOYMILES_DEBUG_LOGGING:
-            #logging.debug(f'INFLUX data to DB: {data_stack}')
-            pass
+        if 'samples' in data:
+            data_stack.extend(self.aggregate_lines(data, templates['measurement'], ctime))
+
+        # queued and written in batches by the write api
         self.api.write(self._bucket, self._org, data_stack)
 
+    def aggregate_lines(self, data, measurement, ctime):
+        """
+        Min/max and energy lines of an aggregated record (see hoymiles.aggregator)
+
+        :return: lines tagged agg=min or agg=max, AC energy of the window as type E_AC (Wh)
+        :rtype: list
+        """
+        lines = []
+        for phase_id, phase in enumerate(data['phases']):
+            for field_id, tag, fmt in self.phase_fields:
+                if f'{field_id}_min' in phase:
+                    lines.append(f'{measurement},phase={phase_id},type={tag},agg=min value={format(phase[field_id + "_min"], fmt)}{ctime}')
+                    lines.append(f'{measurement},phase={phase_id},type={tag},agg=max value={format(phase[field_id + "_max"], fmt)}{ctime}')
+            if 'energy' in phase:
+                lines.append(f'{measurement},phase={phase_id},type=E_AC value={phase["energy"]:.3f}{ctime}')
+        for string_id, string in enumerate(data['strings']):
+            for field_id, tag, fmt in self.string_fields:
+                if f'{field_id}_min' in string:
+                    lines.append(f'{measurement},string={string_id},type={tag},agg=min value={format(string[field_id + "_min"], fmt)}{ctime}')
+                    lines.append(f'{measurement},string={string_id},type={tag},agg=max value={format(string[field_id + "_max"], fmt)}{ctime}')
+        return lines
+
 class MqttOutputPlugin(OutputPluginFactory):
     """ Mqtt output plugin """
     client = None
 
+    # (field id, topic name) pairs used to build the per inverter topic tables
+    global_topics = (('time', 'time'), ('json', 'json'), ('event_count', 'total_events'), ('powerfactor', 'PF_AC'),
+                     ('temperature', 'Temp'), ('yield_total', 'YieldTotal'), ('yield_today', 'YieldToday'),
+                     ('efficiency', 'Efficiency'))
+    phase_topics = (('voltage', 'voltage'), ('current', 'current'), ('power', 'power'), ('reactive_power', 'Q_AC'),
+                    ('frequency', 'frequency'))
+    string_topics = (('voltage', 'voltage'), ('current', 'current'), ('power', 'power'), ('energy_daily', 'YieldDay'),
+                     ('energy_total', 'YieldTotal'), ('irradiation', 'Irradiation'))
+
     def __init__(self, config, **params):
         """
         Initialize MqttOutputPlugin
@@ -205,14 +321,50 @@ class MqttOutputPlugin(OutputPluginFactory):
         self.qos = config.get('QoS', 0)         # Quality of Service
         self.ret = config.get('Retain', True)   # Retain Message
 
+        # 'topics' (default): one topic per value, 'json': one document per inverter and poll
+        self.format = config.get('format', 'topics')
+        self.legacy_topics = config.get('legacy_topics', False)  # json mode: publish power/yield topics too
+        self.topic_tables = {}
+        self.json_writer = None
+        if self.format == 'json':
+            from hoymiles.jsonwriter import JsonWriter
+            self.json_writer = JsonWriter()
+
+        # optional store-and-forward spool for broker outages
+        self.spool = None
+        spool_config = config.get('spool')
+        if spool_config:
+            self.replay_rate = spool_config.get('replay_rate', 50)  # messages replayed per poll
+            self.spool = Spool(spool_config.get('path', 'spool/mqtt'),
+                               segment_size=spool_config.get('segment_size', 65536),
+                               max_segments=spool_config.get('max_segments', 32))
+
     def disco(self, **params):
         self.client.loop_stop()    # Stop loop 
         self.client.disconnect()   # disconnect
+        if self.spool:
+            self.spool.flush()
         return
 
+    def publish(self, topic, payload):
+        """
+        Publish message, spool message while the broker is not connected
+
+        :param str topic: mqtt topic
+        :param payload: message
+        """
+        if self.spool and not self.client.is_connected():
+            self.spool.append(pack_message(topic, payload))
+            return
+        self.client.publish(topic, payload, self.qos, self.ret)
+
+    def _replay(self, record):
+        topic, payload = unpack_message(record)
+        return self.client.publish(topic.decode(), payload, self.qos, self.ret).rc == 0
+
     def info2mqtt(self, mqtt_topic, mqtt_data):
         for mqtt_key in mqtt_data:
-            self.client.publish(f'{mqtt_topic["topic"]}/{mqtt_key}', mqtt_data[mqtt_key], self.qos, self.ret)
+            self.publish(f'{mqtt_topic["topic"]}/{mqtt_key}', mqtt_data[mqtt_key])
         return
 
     def store_status(self, response, **params):
@@ -223,7 +375,7 @@ class MqttOutputPlugin(OutputPluginFactory):
         :param topic: custom mqtt topic prefix (default: hoymiles/{inverter_ser})
         :type topic: str
 
-        :raises ValueError: when response is not instance of StatusResponse
+        :raises ValueError: when response is not instance of StatusResponse, HardwareInfoResponse or EventsResponse
         """
 
         data = response.to_dict()
@@ -232,87 +384,140 @@ class MqttOutputPlugin(OutputPluginFactory):
             logging.warn("received data object is empty")
             return
 
-        topic = params.get('topic', None)
-        if not topic:
-            topic = f'{data.get("inverter_name", "hoymiles")}/{data.get("inverter_ser", None)}'
+        if self.spool and self.spool.depth and self.client.is_connected():
+            self.spool.replay(self._replay, self.replay_rate)
+
+        topics = self.topic_table(data, params.get('topic', None))
+        topic = topics['root']
 
         if HOYMILES_DEBUG_LOGGING:
             logging.info(f'MQTT-topic: {topic} data-type: {type(response)}')
 
-        if isinstance(response, StatusResponse):
+        if isinstance(response, StatusResponse) and self.json_writer:
+            self.store_json(data, topics)
+
+        elif isinstance(response, StatusResponse):
 
             # Global Head
             if data['time'] is not None:
-               self.client.publish(f'{topic}/time', data['time'].strftime("%d.%m.%YT%H:%M:%S"), self.qos, self.ret)
+               self.publish(topics['time'], data['time'].strftime("%d.%m.%YT%H:%M:%S"))
 
             # AC Data
-            phase_id = 0
-            phase_sum_power = 0
             if data['phases'] is not None:
-                for phase in data['phases']:
-                    self.client.publish(f'{topic}/emeter/{phase_id}/voltage', phase['voltage'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter/{phase_id}/current', phase['current'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter/{phase_id}/power', phase['power'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter/{phase_id}/Q_AC', phase['reactive_power'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter/{phase_id}/frequency', phase['frequency'], self.qos, self.ret)
-                    phase_id = phase_id + 1
-                    phase_sum_power += phase['power']
+                for phase, phase_topics in zip(data['phases'], topics['phases']):
+                    self.publish(phase_topics['voltage'], phase['voltage'])
+                    self.publish(phase_topics['current'], phase['current'])
+                    self.publish(phase_topics['power'], phase['power'])
+                    self.publish(phase_topics['reactive_power'], phase['reactive_power'])
+                    self.publish(phase_topics['frequency'], phase['frequency'])
 
             # DC Data
-            string_id = 0
-            string_sum_power = 0
             if data['strings'] is not None:
-                for string in data['strings']:
-                    if 'name' in string:
-                        string_name = string['name'].replace(" ","_")
-                    else:
-                        string_name = string_id
-                    self.client.publish(f'{topic}/emeter-dc/{string_name}/voltage', string['voltage'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter-dc/{string_name}/current', string['current'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter-dc/{string_name}/power', string['power'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter-dc/{string_name}/YieldDay', string['energy_daily'], self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter-dc/{string_name}/YieldTotal', string['energy_total']/1000, self.qos, self.ret)
-                    self.client.publish(f'{topic}/emeter-dc/{string_name}/Irradiation', string['irradiation'], self.qos, self.ret)
-                    string_id = string_id + 1
-                    string_sum_power += string['power']
+                for string, string_topics in zip(data['strings'], topics['strings']):
+                    self.publish(string_topics['voltage'], string['voltage'])
+                    self.publish(string_topics['current'], string['current'])
+                    self.publish(string_topics['power'], string['power'])
+                    self.publish(string_topics['energy_daily'], string['energy_daily'])
+                    self.publish(string_topics['energy_total'], string['energy_total']/1000)
+                    self.publish(string_topics['irradiation'], string['irradiation'])
 
             # Global
             if data['event_count'] is not None:
-               self.client.publish(f'{topic}/total_events', data['event_count'], self.qos, self.ret)
+               self.publish(topics['event_count'], data['event_count'])
             if data['powerfactor'] is not None:
-               self.client.publish(f'{topic}/PF_AC', data['powerfactor'], self.qos, self.ret)
-            self.client.publish(f'{topic}/Temp', data['temperature'], self.qos, self.ret)
+               self.publish(topics['powerfactor'], data['powerfactor'])
+            self.publish(topics['temperature'], data['temperature'])
             if data['yield_total'] is not None:
-               self.client.publish(f'{topic}/YieldTotal', data['yield_total']/1000, self.qos, self.ret)
+               self.publish(topics['yield_total'], data['yield_total']/1000)
             if data['yield_today'] is not None:
-               self.client.publish(f'{topic}/YieldToday', data['yield_today']/1000, self.qos, self.ret)
+               self.publish(topics['yield_today'], data['yield_today']/1000)
             if data['efficiency'] is not None:
-                self.client.publish(f'{topic}/Efficiency', data['efficiency'], self.qos, self.ret)
+                self.publish(topics['efficiency'], data['efficiency'])
 
 
         elif isinstance(response, HardwareInfoResponse):
             if data["FW_ver_maj"] is not None and data["FW_ver_min"] is not None and data["FW_ver_pat"] is not None:
-                self.client.publish(f'{topic}/Firmware/Version',\
-                    f'{data["FW_ver_maj"]}.{data["FW_ver_min"]}.{data["FW_ver_pat"]}', self.qos, self.ret)
+                self.publish(f'{topic}/Firmware/Version',\
+                    f'{data["FW_ver_maj"]}.{data["FW_ver_min"]}.{data["FW_ver_pat"]}')
 
             if data["FW_build_dd"] is not None and data["FW_build_mm"] is not None and data["FW_build_yy"] is not None and data["FW_build_HH"] is not None and data["FW_build_MM"] is not None:
-                self.client.publish(f'{topic}/Firmware/Build_at',\
-                    f'{data["FW_build_dd"]}/{data["FW_build_mm"]}/{data["FW_build_yy"]}T{data["FW_build_HH"]}:{data["FW_build_MM"]}',\
-                    self.qos, self.ret)
+                self.publish(f'{topic}/Firmware/Build_at',\
+                    f'{data["FW_build_dd"]}/{data["FW_build_mm"]}/{data["FW_build_yy"]}T{data["FW_build_HH"]}:{data["FW_build_MM"]}')
 
             if data["FW_HW_ID"] is not None:
-                self.client.publish(f'{topic}/Firmware/HWPartId',\
-                    f'{data["FW_HW_ID"]}', self.qos, self.ret)
+                self.publish(f'{topic}/Firmware/HWPartId',\
+                    f'{data["FW_HW_ID"]}')
+
+        elif isinstance(response, EventsResponse):
+            for alarm in data['alarms']:
+                self.publish(f'{topic}/alarm', json.dumps(alarm))
 
         else:
-             raise ValueError('Data needs to be instance of StatusResponse or a instance of HardwareInfoResponse')
+             raise ValueError('Data needs to be instance of StatusResponse, HardwareInfoResponse or EventsResponse')
+
+    def store_json(self, data, topics):
+        """
+        Publish status data as single JSON document to {topic}/json
+
+        :param dict data: decoded StatusResponse data
+        :param dict topics: topic table of the inverter
+        """
+        self.publish(topics['json'], self.json_writer.dumps(data))
+
+        if self.legacy_topics:
+            for phase, phase_topics in zip(data['phases'], topics['phases']):
+                self.publish(phase_topics['power'], phase['power'])
+            if data['yield_total'] is not None:
+               self.publish(topics['yield_total'], data['yield_total']/1000)
+            if data['yield_today'] is not None:
+               self.publish(topics['yield_today'], data['yield_today']/1000)
+
+    def topic_table(self, data, topic=None):
+        """
+        Get topics of an inverter keyed by field id. Topics are built once when
+        the inverter (or a new phase/string) is first seen.
+
+        :param dict data: decoded response data
+        :param topic: custom mqtt topic prefix (default: {inverter_name}/{inverter_ser})
+        :type topic: str or None
+        :return: topic table
+        :rtype: dict
+        """
+        key = topic if topic else data.get('inverter_ser', None)
+        topics = self.topic_tables.get(key)
+        if topics is None:
+            if not topic:
+                topic = f'{data.get("inverter_name", "hoymiles")}/{data.get("inverter_ser", None)}'
+            topics = {'root': topic, 'phases': [], 'strings': []}
+            for field_id, name in self.global_topics:
+                topics[field_id] = f'{topic}/{name}'
+            self.topic_tables[key] = topics
+
+        topic = topics['root']
+        phases = data.get('phases') or []
+        while len(topics['phases']) < len(phases):
+            phase_id = len(topics['phases'])
+            topics['phases'].append({field_id: f'{topic}/emeter/{phase_id}/{name}' for field_id, name in self.phase_topics})
+
+        strings = data.get('strings') or []
+        while len(topics['strings']) < len(strings):
+            string_id = len(topics['strings'])
+            string = strings[string_id]
+            string_name = string['name'].replace(" ","_") if 'name' in string else string_id
+            topics['strings'].append({field_id: f'{topic}/emeter-dc/{string_name}/{name}' for field_id, name in self.string_topics})
+        return topics
 
 class VzInverterOutput:
-    def __init__(self, config, session):
+    max_buffered = 1000  # tuples per channel kept while the middleware is not reachable
+
+    def __init__(self, config, session, spool=None):
         self.session = session
         self.serial = config.get('serial')
         self.baseurl = config.get('url', 'http://localhost/middleware/')
         self.channels = dict()
+        self.pending = dict()  # uid -> list of [ts, value] not yet accepted by the middleware
+        self.spool = spool     # optional store-and-forward spool, takes pending tuples of failed requests
+        self.replay_rate = 200 # tuples replayed per poll
 
         for channel in config.get('channels', []):
             uid = channel.get('uid', None)
@@ -323,7 +528,7 @@ class VzInverterOutput:
 
     def store_status(self, data, session):
         """
-        Publish StatusResponse object
+        Publish StatusResponse object, all channel values of a poll are sent with a single request
 
         :param hoymiles.decoders.StatusResponse response: StatusResponse object
 
@@ -340,64 +545,138 @@ class VzInverterOutput:
         # AC Data
         phase_id = 0
         for phase in data['phases']:
-            self.try_publish(ts, f'ac_voltage{phase_id}', phase['voltage'])
-            self.try_publish(ts, f'ac_current{phase_id}', phase['current'])
-            self.try_publish(ts, f'ac_power{phase_id}', phase['power'])
-            self.try_publish(ts, f'ac_reactive_power{phase_id}', phase['reactive_power'])
-            self.try_publish(ts, f'ac_frequency{phase_id}', phase['frequency'])
+            self.add_value(ts, f'ac_voltage{phase_id}', phase['voltage'])
+            self.add_value(ts, f'ac_current{phase_id}', phase['current'])
+            self.add_value(ts, f'ac_power{phase_id}', phase['power'])
+            self.add_value(ts, f'ac_reactive_power{phase_id}', phase['reactive_power'])
+            self.add_value(ts, f'ac_frequency{phase_id}', phase['frequency'])
+            if 'energy' in phase:  # aggregated record
+                self.add_value(ts, f'ac_power_min{phase_id}', phase['power_min'])
+                self.add_value(ts, f'ac_power_max{phase_id}', phase['power_max'])
+                self.add_value(ts, f'ac_energy{phase_id}', phase['energy'])
             phase_id = phase_id + 1
 
         # DC Data
         string_id = 0
         for string in data['strings']:
-            self.try_publish(ts, f'dc_voltage{string_id}', string['voltage'])
-            self.try_publish(ts, f'dc_current{string_id}', string['current'])
-            self.try_publish(ts, f'dc_power{string_id}', string['power'])
-            self.try_publish(ts, f'dc_energy_daily{string_id}', string['energy_daily'])
-            self.try_publish(ts, f'dc_energy_total{string_id}', string['energy_total'])
-            self.try_publish(ts, f'dc_irradiation{string_id}', string['irradiation'])
+            self.add_value(ts, f'dc_voltage{string_id}', string['voltage'])
+            self.add_value(ts, f'dc_current{string_id}', string['current'])
+            self.add_value(ts, f'dc_power{string_id}', string['power'])
+            self.add_value(ts, f'dc_energy_daily{string_id}', string['energy_daily'])
+            self.add_value(ts, f'dc_energy_total{string_id}', string['energy_total'])
+            self.add_value(ts, f'dc_irradiation{string_id}', string['irradiation'])
             string_id = string_id + 1
 
         # Global
         if data['event_count'] is not None:
-            self.try_publish(ts, f'event_count', data['event_count'])
+            self.add_value(ts, f'event_count', data['event_count'])
         if data['powerfactor'] is not None:
-            self.try_publish(ts, f'powerfactor', data['powerfactor'])
-        self.try_publish(ts, f'temperature', data['temperature'])
+            self.add_value(ts, f'powerfactor', data['powerfactor'])
+        self.add_value(ts, f'temperature', data['temperature'])
         if data['yield_total'] is not None:
-            self.try_publish(ts, f'yield_total', data['yield_total'])
+            self.add_value(ts, f'yield_total', data['yield_total'])
         if data['yield_today'] is not None:
-            self.try_publish(ts, f'yield_today', data['yield_today'])
-        self.try_publish(ts, f'efficiency', data['efficiency'])
+            self.add_value(ts, f'yield_today', data['yield_today'])
+        self.add_value(ts, f'efficiency', data['efficiency'])
+
+        self.flush()
         return
 
-    def try_publish(self, ts, ctype, value):
+    def add_value(self, ts, ctype, value):
+        """ Buffer value of channel type ctype until next flush() """
+        if value is None:
+            return
         if not ctype in self.channels:
             if HOYMILES_DEBUG_LOGGING:
                 logging.warning(f'ctype \"{ctype}\" not found in ahoy.yml')
             return
 
         uid = self.channels[ctype]
-        url = f'{self.baseurl}/data/{uid}.json?operation=add&ts={ts}&value={value}'
-        if uid == None:
+        if not uid:
             if HOYMILES_DEBUG_LOGGING:
                 logging.debug(f'ctype \"{ctype}\" has no configured uid-value in ahoy.yml')
             return
 
+        tuples = self.pending.setdefault(uid, [])
+        if len(tuples) >= self.max_buffered:
+            tuples.pop(0)
+        tuples.append([ts, value])
+
+    def flush(self):
+        """
+        Send all buffered tuples with one request to the middleware.
+        Tuples are kept and resent with the next poll (or spooled) if the middleware is not reachable,
+        tuples rejected by the middleware are dropped.
+
+        :raises ConnectionError: when the middleware is not reachable
+        :raises ValueError: when the middleware did not accept the data
+        """
+        if not self.pending:
+            return
+
+        try:
+            self.post([{'uuid': uid, 'tuples': tuples} for uid, tuples in self.pending.items()])
+        except ConnectionError:
+            if self.spool:
+                for uid, tuples in self.pending.items():
+                    for ts, value in tuples:
+                        self.spool.append(f'{uid} {ts} {value}'.encode())
+                self.pending.clear()
+            raise
+        except ValueError:
+            self.pending.clear()  # can never succeed
+            raise
+        self.pending.clear()
+
+        if self.spool and self.spool.depth:
+            self.replay()
+
+    def replay(self):
+        """ Send spooled tuples in bulk, throttled to replay_rate tuples per call """
+        records = self.spool.read(self.replay_rate)
+        body = dict()
+        for record in records:
+            try:
+                uid, ts, value = record.decode().split(' ')
+                ts, value = int(ts), float(value)
+            except ValueError:
+                logging.warning(f'Dropped invalid spool record {record}')
+                continue
+            body.setdefault(uid, []).append([ts, value])
+        try:
+            if body:
+                self.post([{'uuid': uid, 'tuples': tuples} for uid, tuples in body.items()])
+        except ValueError:
+            self.spool.commit(len(records))  # rejected by the middleware, replaying does not help
+            raise
+        self.spool.commit(len(records))
+
+    def post(self, body):
+        """
+        Post tuples of several channels with one request
+
+        :param list body: list of {'uuid': uid, 'tuples': [[ts, value], ...]}
+        :raises ConnectionError: when the middleware is not reachable (network error or 5xx response)
+        :raises ValueError: when the middleware did not accept the data
+        """
+        url = f'{self.baseurl}/data.json'
+
         if HOYMILES_DEBUG_LOGGING:
-            logging.debug(f'VZ-url: {url}')
+            logging.debug(f'VZ-url: {url} channels: {len(body)}')
 
         try:
-            r = self.session.get(url)
-            if r.status_code == 404:
-                logging.critical('VZ-DB not reachable, please check "middleware"')
-            if r.status_code == 400:
-                logging.critical('UUID not configured in VZ-DB')
-            elif r.status_code != 200:
-               raise ValueError(f'Transmit result {url}')
-        except ConnectionError as e:
-            raise ValueError(f'Could not connect VZ-DB {type(e)} {e.keys()}')
-        return
+            r = self.session.post(url, json=body, timeout=10)
+        except Exception as e:
+            raise ConnectionError(f'Could not connect VZ-DB {type(e)} {e}')
+
+        if r.status_code == 404:
+            logging.critical('VZ-DB not reachable, please check "middleware"')
+        elif r.status_code == 400:
+            logging.critical('UUID not configured in VZ-DB')
+        if r.status_code >= 500:
+            raise ConnectionError(f'Transmit result {r.status_code} {url}')
+        if r.status_code != 200:
+            raise ValueError(f'Transmit result {r.status_code} {url}')
 
 class VolkszaehlerOutputPlugin(OutputPluginFactory):
     def __init__(self, config, **params):
@@ -408,25 +687,41 @@ class VolkszaehlerOutputPlugin(OutputPluginFactory):
 
         try:
             import requests
-            import time
+            from requests.adapters import HTTPAdapter
         except ModuleNotFoundError:
-            ErrorText1 = f'Module "requests" and "time" for VolkszaehlerOutputPlugin necessary.'
+            ErrorText1 = f'Module "requests" for VolkszaehlerOutputPlugin necessary.'
             ErrorText2 = f'Install module with command: python3 -m pip install requests'
             print(ErrorText1, ErrorText2)
             logging.error(ErrorText1)
             logging.error(ErrorText2)
             exit(1)
 
+        # keep connections to the middleware open between polls
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        spool_config = config.get('spool')
 
         self.inverters = dict()
         for inverterconfig in config.get('inverters', []):
             serial = inverterconfig.get('serial')
-            output = VzInverterOutput(inverterconfig, self.session)
+            spool = None
+            if spool_config:
+                spool = Spool(f'{spool_config.get("path", "spool/volkszaehler")}/{serial}',
+                              segment_size=spool_config.get('segment_size', 65536),
+                              max_segments=spool_config.get('max_segments', 32))
+            output = VzInverterOutput(inverterconfig, self.session, spool)
+            if spool_config:
+                output.replay_rate = spool_config.get('replay_rate', output.replay_rate)
             self.inverters[serial] = output
 
     def disco(self, **params):
         self.session.close()            # closing the connection
+        for output in self.inverters.values():
+            if output.spool:
+                output.spool.flush()
         return
 
     def store_status(self, response, **params):
@@ -451,6 +746,186 @@ class VolkszaehlerOutputPlugin(OutputPluginFactory):
             output = self.inverters[serial]
             try:
                 output.store_status(data, self.session)
-            except ValueError as e:
+            except (ValueError, ConnectionError) as e:
                 logging.warning('Could not send data to volkszaehler instance: %s' % e)
         return
+
+class PrometheusOutputPlugin(OutputPluginFactory):
+    """
+    Prometheus exporter (text format), serves http://<host>:<port>/metrics
+
+    The exposition text of all inverters is rendered once per poll (store_status)
+    and cached, the registered health counters are rendered per scrape (they keep
+    changing at night without polls).
+    """
+
+    # (metric name, data key)
+    global_metrics = (('temperature', 'temperature'), ('powerfactor', 'powerfactor'),
+                      ('yield_total', 'yield_total'), ('yield_today', 'yield_today'),
+                      ('efficiency', 'efficiency'), ('event_count', 'event_count'))
+    phase_metrics = (('ac_voltage', 'voltage'), ('ac_current', 'current'), ('ac_power', 'power'),
+                     ('ac_reactive_power', 'reactive_power'), ('ac_frequency', 'frequency'))
+    string_metrics = (('dc_voltage', 'voltage'), ('dc_current', 'current'), ('dc_power', 'power'),
+                      ('dc_energy_total', 'energy_total'), ('dc_energy_daily', 'energy_daily'),
+                      ('dc_irradiation', 'irradiation'))
+    # health keys exported as gauge, all others are monotonic counters (<prefix>_<name>_<key>_total)
+    health_gauges = ('depth', 'segments', 'replay_rate', 'latency_ms', 'max_latency_ms', 'poll_latency_ms',
+                     'dirty', 'inverters', 'clients', 'event_clients')
+
+    def __init__(self, config, **params):
+        """
+        Initialize PrometheusOutputPlugin
+
+        :param dict config: prometheus config (host, port, prefix)
+        """
+        super().__init__(**params)
+
+        self.host = config.get('host', '0.0.0.0')
+        self.port = config.get('port', 9099)
+        self.prefix = config.get('prefix', 'hoymiles')
+
+        self.latest = {}        # inverter serial -> (labels, data)
+        self.health = []        # (name, provider, label)
+        self.body = b''        # inverter samples of the last poll
+        self.scrapes = 0
+
+    def add_health(self, name, provider, label=None):
+        """
+        Register health counters, exported as counter <prefix>_<name>_<key>_total
+        or as gauge <prefix>_<name>_<key> if key is in health_gauges
+
+        :param str name: metric group name
+        :param provider: callable returning a dict of counters, with label a dict of
+                         such dicts (e.g. OutputDispatcher.metrics)
+        :param str label: label name of the outer dict keys
+        """
+        self.health.append((name, provider, label))
+
+    def store_status(self, response, **params):
+        """
+        Store StatusResponse object and render exposition text
+
+        :param hoymiles.decoders.StatusResponse response: StatusResponse object
+
+        :raises ValueError: when response is not instance of StatusResponse
+        """
+
+        if not isinstance(response, StatusResponse):
+            raise ValueError('Data needs to be instance of StatusResponse')
+
+        data = response.to_dict()
+        serial = data['inverter_ser']
+        if serial not in self.latest:
+            self.latest[serial] = (f'inverter="{_label(data["inverter_name"])}",serial="{serial}"', data)
+        else:
+            self.latest[serial] = (self.latest[serial][0], data)
+
+        self.body = self.render().encode()
+
+    def render(self):
+        """
+        Build exposition text of the inverter values, samples are grouped by metric
+
+        :rtype: str
+        """
+        lines = []
+        prefix = self.prefix
+
+        for name, key in self.global_metrics:
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            for labels, data in self.latest.values():
+                if data.get(key) is not None:
+                    lines.append(f'{prefix}_{name}{{{labels}}} {data[key]}')
+
+        for name, key in self.phase_metrics:
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            for labels, data in self.latest.values():
+                for i, phase in enumerate(data.get('phases') or []):
+                    lines.append(f'{prefix}_{name}{{{labels},phase="{i}"}} {phase[key]}')
+
+        for name, key in self.string_metrics:
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            for labels, data in self.latest.values():
+                for i, string in enumerate(data.get('strings') or []):
+                    string_name = _label(string.get('name', f'String {i}'))
+                    lines.append(f'{prefix}_{name}{{{labels},string="{i}",name="{string_name}"}} {string[key]}')
+
+        lines.append(f'# TYPE {prefix}_last_update_timestamp_seconds gauge')
+        for labels, data in self.latest.values():
+            if data.get('time') is not None:
+                lines.append(f'{prefix}_last_update_timestamp_seconds{{{labels}}} {data["time"].timestamp():.0f}')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def render_health(self):
+        """
+        Build exposition text of the registered health counters
+
+        :rtype: str
+        """
+        lines = []
+        prefix = self.prefix
+        for name, provider, label in self.health:
+            try:
+                counters = provider()
+            except Exception as e:
+                logging.warning(f'prometheus health provider {name} failed: {e}')
+                continue
+            if label:
+                keys = []
+                for values in counters.values():
+                    keys.extend(key for key in values if key not in keys)
+                for key in keys:
+                    metric = self._health_type(lines, f'{prefix}_{name}_{key}', key)
+                    for item, values in counters.items():
+                        if key in values:
+                            lines.append(f'{metric}{{{label}="{item}"}} {values[key]}')
+            else:
+                for key, value in counters.items():
+                    metric = self._health_type(lines, f'{prefix}_{name}_{key}', key)
+                    lines.append(f'{metric} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _health_type(self, lines, metric, key):
+        # append the TYPE line, return the sample name
+        if key in self.health_gauges:
+            lines.append(f'# TYPE {metric} gauge')
+            return metric
+        lines.append(f'# TYPE {metric}_total counter')
+        return f'{metric}_total'
+
+    async def serve(self):
+        """Run http server (within running event loop)"""
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f'prometheus exporter listening on {self.host}:{self.port}')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while True:  # skip headers
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if not line or line == b'\r\n':
+                    break
+            path = request.split(b' ')[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] == b'/metrics':
+                body = self.body + self.render_health().encode()
+                self.scrapes += 1
+                writer.write(b'HTTP/1.0 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+            else:
+                writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+        except Exception as e:
+            if HOYMILES_DEBUG_LOGGING:
+                logging.debug(f'prometheus request failed: {e}')
+        finally:
+            writer.close()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
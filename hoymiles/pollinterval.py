@@ -0,0 +1,68 @@
+"""
+Adaptive poll interval driven by the elevation of the sun (CPython and Micropython)
+
+The expected production follows the sine of the sun elevation. The interval is
+scaled between max_interval (sun below the horizon, dawn, dusk) and
+min_interval (sun at its highest elevation of the day). If the ac power of an
+inverter changed by more than power_change since its last poll, the next poll
+is done after min_interval.
+"""
+
+import time
+
+from .sun_moon import RiSet, get_mjd
+
+
+class SolarPollInterval:
+
+    def __init__(self, config, latitude, longitude):
+        """
+        :param dict config: min_interval, max_interval (seconds), power_change (relative change of ac power,
+                            changes below power_threshold watts are ignored)
+        :param float latitude: latitude in degrees
+        :param float longitude: longitude in degrees (west negative)
+        """
+        self.min_interval = config.get('min_interval', 5)
+        self.max_interval = config.get('max_interval', 60)
+        self.power_change = config.get('power_change', 0.1)
+        self.power_threshold = config.get('power_threshold', 20)
+        self.longitude = longitude
+        RiSet.verbose = False
+        self.riset = RiSet(lat=latitude, long=longitude)
+        self._mjd = None
+        self._noon = 1.0      # sin(elevation) at solar noon of the day
+        self.elevation = 0.0  # sin(elevation) of the last interval()
+        self.power = {}       # inverter serial -> ac power of the last poll
+        self.changing = False
+
+    def update(self, serial, power):
+        """
+        Record ac power of an inverter poll
+
+        :param serial: inverter serial
+        :param float power: ac power in W
+        """
+        previous = self.power.get(serial)
+        if previous is not None:
+            delta = abs(power - previous)
+            if delta > self.power_threshold and delta > self.power_change * previous:
+                self.changing = True
+        self.power[serial] = power
+
+    def interval(self):
+        """
+        Seconds until the next poll
+
+        :rtype: float
+        """
+        if self.changing:
+            self.changing = False
+            return self.min_interval
+        mjd = get_mjd()
+        if mjd != self._mjd:
+            self._mjd = self.riset.mjd = mjd
+            self._noon = max(self.riset.sin_alt(12 - self.longitude / 15, True), 0.01)
+        t = time.gmtime()
+        self.elevation = self.riset.sin_alt(t[3] + t[4] / 60 + t[5] / 3600, True)
+        ratio = min(max(self.elevation / self._noon, 0.0), 1.0)
+        return self.max_interval - (self.max_interval - self.min_interval) * ratio
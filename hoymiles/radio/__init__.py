@@ -4,6 +4,7 @@ from datetime import datetime
 from os import environ
 
 from hoymiles import HOYMILES_DEBUG_LOGGING, hexify_payload
+import hoymiles.log as log
 
 try:
     # OSI Layer 2 driver for nRF24L01 on Arduino & Raspberry Pi/Linux Devices
@@ -68,9 +69,10 @@ class HoymilesNRF:
 
         self.next_tx_channel()
 
-        if HOYMILES_DEBUG_LOGGING:
+        if HOYMILES_DEBUG_LOGGING and log.enabled(log.DEBUG):
             c_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-            logging.debug(f'{c_datetime} Transmit {len(packet)} bytes channel {self.tx_channel}: {hexify_payload(packet)}')
+            log.debug('%s Transmit %d bytes channel %d: %s', c_datetime, len(packet), self.tx_channel,
+                      hexify_payload(packet))
 
         if not txpower:
             txpower = self.txpower
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Store-and-forward spool for output plugins (CPython and Micropython)
+
+Records (bytes) are appended to size limited segment files in a directory. The
+segments form a ring: if max_segments is exceeded the oldest segment is evicted.
+Records are buffered in RAM and written in batches to limit flash wear.
+Replay returns records in the order they were appended. The read position within the
+oldest segment is kept in RAM only, after a restart records of this segment may be
+delivered twice.
+"""
+
+import os
+import time
+import struct
+
+
+class Spool:
+
+    def __init__(self, path, segment_size=16384, max_segments=16, batch_size=512, flush_interval=60):
+        """
+        :param str path: spool directory (created if missing)
+        :param int segment_size: maximum size of one segment file in bytes
+        :param int max_segments: maximum number of segment files, oldest is evicted
+        :param int batch_size: write buffered records if buffer exceeds this size in bytes
+        :param int flush_interval: write buffered records at least every flush_interval seconds
+        """
+        self.path = path.rstrip('/')
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.buffer = bytearray()
+        self.buffered = 0        # records in buffer
+        self.last_flush = time.time()
+        self.segments = []       # segment numbers, oldest first
+        self.counts = {}         # segment number -> unread records
+        self.head_offset = 0     # read position in oldest segment
+        # metrics
+        self.evictions = 0
+        self.replayed = 0
+        self.replay_rate = 0     # records per second since previous replay
+        self._last_replay = time.time()
+
+        _makedirs(self.path)
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.spl'):
+                seg = int(name[:-4])
+                self.segments.append(seg)
+                self.counts[seg] = len(self._scan(seg))
+
+    @property
+    def depth(self):
+        """Number of records waiting for replay"""
+        return sum(self.counts.values()) + self.buffered
+
+    def metrics(self):
+        return {'depth': self.depth, 'segments': len(self.segments), 'evictions': self.evictions,
+                'replayed': self.replayed, 'replay_rate': self.replay_rate}
+
+    def append(self, record):
+        """
+        Add record, written to flash with the next batch
+
+        :param bytes record: record up to 65535 bytes
+        """
+        self.buffer.extend(struct.pack('>H', len(record)))
+        self.buffer.extend(record)
+        self.buffered += 1
+        if len(self.buffer) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write buffered records to the newest segment"""
+        self.last_flush = time.time()
+        if not self.buffered:
+            return
+        seg = self.segments[-1] if self.segments else 0
+        if not self.segments or self._size(seg) + len(self.buffer) > self.segment_size:
+            seg += 1
+            self.segments.append(seg)
+            self.counts[seg] = 0
+        with open(self._name(seg), 'ab') as f:
+            f.write(self.buffer)
+        self.counts[seg] += self.buffered
+        self.buffer = bytearray()
+        self.buffered = 0
+
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            self.evictions += self.counts.pop(oldest)
+            self.head_offset = 0
+            os.remove(self._name(oldest))
+
+    def read(self, max_records):
+        """
+        Get oldest records without removing them, call commit() once they are delivered
+
+        :param int max_records: maximum number of records returned
+        :return: records oldest first
+        :rtype: list
+        """
+        self.flush()
+        records = []
+        offset = self.head_offset
+        for seg in self.segments:
+            for record, offset in self._scan(seg, offset, max_records - len(records)):
+                records.append(record)
+            if len(records) >= max_records:
+                break
+            offset = 0
+        return records
+
+    def commit(self, count):
+        """
+        Remove count oldest records (returned by read() before)
+
+        :param int count: number of delivered records
+        """
+        while count > 0 and self.segments:
+            seg = self.segments[0]
+            scanned = self._scan(seg, self.head_offset, count)
+            if scanned:
+                self.head_offset = scanned[-1][1]
+            count -= len(scanned)
+            self.counts[seg] -= len(scanned)
+            if self.counts[seg] <= 0:
+                self.segments.pop(0)
+                self.counts.pop(seg)
+                self.head_offset = 0
+                os.remove(self._name(seg))
+
+    def replay(self, handler, max_records=20):
+        """
+        Deliver up to max_records oldest records, stops at the first failed record
+
+        :param handler: callable(record) returns True if the record was delivered
+        :param int max_records: throttle, maximum number of records per call
+        :return: number of delivered records
+        :rtype: int
+        """
+        if not self.depth:
+            return 0
+        now = time.time()
+        delivered = 0
+        for record in self.read(max_records):
+            try:
+                if not handler(record):
+                    break
+            except Exception:
+                break
+            delivered += 1
+        self.commit(delivered)
+        self.replayed += delivered
+        self.replay_rate = delivered / max(now - self._last_replay, 1)
+        self._last_replay = now
+        return delivered
+
+    def _name(self, seg):
+        return f'{self.path}/{seg:08d}.spl'
+
+    def _size(self, seg):
+        try:
+            return os.stat(self._name(seg))[6]
+        except OSError:
+            return 0
+
+    def _scan(self, seg, offset=0, max_records=None):
+        # list of (record, offset after record)
+        result = []
+        with open(self._name(seg), 'rb') as f:
+            f.seek(offset)
+            while max_records is None or len(result) < max_records:
+                header = f.read(2)
+                if len(header) < 2:
+                    break
+                length = struct.unpack('>H', header)[0]
+                record = f.read(length)
+                if len(record) < length:
+                    break  # incomplete record (power loss during write)
+                offset += 2 + length
+                result.append((record, offset))
+        return result
+
+
+def _makedirs(path):
+    current = '/' if path.startswith('/') else ''
+    for part in path.split('/'):
+        if not part:
+            continue
+        current += part
+        try:
+            os.mkdir(current)
+        except OSError:
+            pass
+        current += '/'
+
+
+def pack_message(topic, payload):
+    """
+    Encode mqtt message as spool record
+
+    :param topic: mqtt topic
+    :type topic: str or bytes
+    :param payload: message, non bytes values are converted with str()
+    :return: record
+    :rtype: bytes
+    """
+    if isinstance(topic, str):
+        topic = topic.encode()
+    if isinstance(payload, str):
+        payload = payload.encode()
+    elif not isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = str(payload).encode()
+    return struct.pack('>H', len(topic)) + topic + bytes(payload)
+
+
+def unpack_message(record):
+    """
+    Decode spool record created by pack_message()
+
+    :return: topic, payload
+    :rtype: tuple
+    """
+    length = struct.unpack('>H', record[:2])[0]
+    return record[2:2 + length], record[2 + length:]
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Persistent DTU state (CPython and Micropython)
+
+One binary file of versioned records, written only if the state changed and at
+most every interval seconds (flash wear). The file is written to a temporary
+file and renamed, a power loss keeps the previous state::
+
+    b'HMS1'
+    record: type (uint8), version (uint8), length (uint16), payload
+            type 1 dtu:      polls, timeouts, retries, crc_errors (uint32), tx, rx channel id (uint8)
+            type 2 inverter: serial (uint64), event message index (uint16), pending requests
+                             (uint8 count, uint8 length + command id (uint8), alarm id (uint16, big endian) each),
+                             hardware info response (uint8 length + payload)
+
+Records of unknown type or version and malformed records are skipped, little endian.
+"""
+
+import os
+import time
+import struct
+
+import hoymiles.log as log
+
+_MAGIC = b'HMS1'
+_REC_DTU = 1
+_REC_INVERTER = 2
+_ERRORS = (ValueError, IndexError, getattr(struct, 'error', ValueError))  # malformed data (micropython: ValueError)
+_STATS = ('polls', 'timeouts', 'retries', 'crc_errors')
+
+
+class InverterState:
+    """State of one inverter"""
+
+    def __init__(self, event_index=0, commands=None, hardware_info=b''):
+        self.event_index = event_index
+        self.commands = commands if commands is not None else []  # pending requests: command id + alarm id (3 bytes)
+        self.hardware_info = hardware_info  # raw HardwareInfoResponse payload
+
+
+class StateStore:
+
+    def __init__(self, path, interval=600):
+        """
+        :param str path: state file
+        :param int interval: minimum seconds between two writes
+        """
+        self.path = path
+        self.interval = interval
+        self.stats = {}
+        self.channels = (None, None)  # tx, rx channel id
+        self.inverters = {}           # serial (str) -> InverterState
+        self.dirty = False
+        self.last_write = 0
+        self.writes = 0
+        self.errors = 0
+
+    def inverter(self, serial):
+        """
+        :param str serial: inverter serial
+        :rtype: InverterState
+        """
+        state = self.inverters.get(serial)
+        if state is None:
+            state = self.inverters[serial] = InverterState()
+        return state
+
+    def changed(self):
+        """Mark state as changed, written with the next save()"""
+        self.dirty = True
+
+    def save(self, force=False):
+        """
+        Write state if changed and interval passed since the last write
+
+        :param bool force: write even if interval did not pass (e.g. before sleep or shutdown)
+        :return: True if written
+        """
+        now = time.time()
+        if not self.dirty or (not force and now - self.last_write < self.interval):
+            return False
+        data = bytearray(_MAGIC)
+        payload = struct.pack('<IIII', *[self.stats.get(key, 0) & 0xffffffff for key in _STATS])
+        payload += struct.pack('<BB', *[0xff if ch is None else ch for ch in self.channels])
+        _add_record(data, _REC_DTU, payload)
+        for serial, state in self.inverters.items():
+            payload = bytearray(struct.pack('<QHB', int(serial), state.event_index, len(state.commands)))
+            for command in state.commands:
+                payload.append(len(command))
+                payload.extend(command)
+            payload.append(len(state.hardware_info))
+            payload.extend(state.hardware_info)
+            _add_record(data, _REC_INVERTER, payload)
+
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            _replace(tmp, self.path)
+        except OSError as e:  # flash full or failing, keep polling and try again after interval
+            self.errors += 1
+            self.last_write = now
+            log.warning('Could not write state %s: %s', self.path, e)
+            return False
+        self.dirty = False
+        self.last_write = now
+        self.writes += 1
+        return True
+
+    def load(self):
+        """
+        Read state file
+
+        :return: True if a state was read, False if there is no state or it is corrupt
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        if data[:4] != _MAGIC:
+            return False
+        try:
+            self._parse(data)
+        except _ERRORS as e:
+            log.warning('Corrupt state %s: %s', self.path, e)
+            self.stats = {}
+            self.channels = (None, None)
+            self.inverters = {}
+            return False
+        self.last_write = time.time()
+        return True
+
+    def _parse(self, data):
+        mv = memoryview(data)
+        pos = 4
+        while pos + 4 <= len(data):
+            rec_type, version, length = struct.unpack_from('<BBH', data, pos)
+            pos += 4
+            payload = mv[pos:pos + length]
+            pos += length
+            if len(payload) < length:
+                break  # truncated
+            if version != 1:
+                continue
+            if rec_type == _REC_DTU and length >= 18:
+                self.stats = dict(zip(_STATS, struct.unpack_from('<IIII', payload, 0)))
+                self.channels = tuple(None if ch == 0xff else ch for ch in struct.unpack_from('<BB', payload, 16))
+            elif rec_type == _REC_INVERTER and length >= 11:
+                state = _parse_inverter(payload, length)
+                if state is None:
+                    log.warning('Skipped malformed inverter record')
+                    continue
+                self.inverters[state[0]] = state[1]
+
+    def metrics(self):
+        return {'writes': self.writes, 'errors': self.errors, 'dirty': int(self.dirty), 'inverters': len(self.inverters)}
+
+
+def _parse_inverter(payload, length):
+    # serial (str), InverterState or None if a field exceeds the record
+    serial, event_index, count = struct.unpack_from('<QHB', payload, 0)
+    p = 11
+    commands = []
+    for _ in range(count):
+        if p >= length or p + 1 + payload[p] > length:
+            return None
+        commands.append(bytes(payload[p + 1:p + 1 + payload[p]]))
+        p += 1 + payload[p]
+    hardware_info = b''
+    if p < length:
+        if p + 1 + payload[p] > length:
+            return None
+        hardware_info = bytes(payload[p + 1:p + 1 + payload[p]])
+    return str(serial), InverterState(event_index, commands, hardware_info)
+
+
+def _replace(src, dst):
+    # replace dst by src, dst is kept if anything fails before
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)  # littlefs replaces dst
+    except OSError:  # FAT does not, dst is missing for a moment
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        os.rename(src, dst)
+
+
+def _add_record(data, rec_type, payload, version=1):
+    data.extend(struct.pack('<BBH', rec_type, version, len(payload)))
+    data.extend(payload)
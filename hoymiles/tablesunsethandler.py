@@ -0,0 +1,151 @@
+"""
+Sunset handler using a precomputed yearly table of sunrise and sunset (CPython and Micropython)
+
+The table holds sunrise and sunset in minutes after midnight UTC (uint16, little
+endian) for every day of a leap year (Jan 1st ... Dec 31st) at the configured location::
+
+    b'SUN1', latitude * 10000 (int32), longitude * 10000 (int32)
+    366 x (sunrise, sunset)
+
+It is computed once with sun_moon.py (if the file is missing or was created for
+another location) and stored in flash. Afterwards sun_moon.py is not needed, a
+lookup reads 4 bytes of the file once per day. No network connection is used.
+Build the table on a PC and copy it to the device to skip the computation:
+
+    python3 -m hoymiles.tablesunsethandler 51.799118 10.615523 -o suntimes.bin
+    mpremote cp suntimes.bin :
+"""
+
+import time
+import struct
+import asyncio
+
+_MAGIC = b'SUN1'
+_HEADER = '<4sii'
+_HEADER_SIZE = 12
+_DAYS = 366
+_MJD_2024 = 60310  # modified julian date of 2024-01-01 (leap year, has all days of year)
+
+
+def build_table(latitude, longitude, path):
+    """
+    Compute sunrise and sunset of every day of year and write the table
+
+    :param float latitude: latitude in degrees
+    :param float longitude: longitude in degrees (west negative)
+    :param str path: table file
+    """
+    from math import sin, radians
+    from .sun_moon import RiSet
+
+    RiSet.verbose = False
+    riset = RiSet(lat=latitude, long=longitude)
+    sinho = sin(radians(-0.833))
+    table = bytearray(4 * _DAYS)
+    for day in range(_DAYS):
+        riset.mjd = _MJD_2024 + day
+        sunrise, sunset = riset.rise_set(True, False)
+        if sunrise is None and sunset is None:  # polar day or night
+            up = riset.sin_alt(12 - longitude / 15, True) > sinho  # solar noon
+            sunrise, sunset = (0, 86400) if up else (86400, 86400)
+        struct.pack_into('<HH', table, 4 * day, 0 if sunrise is None else (sunrise + 30) // 60,
+                         1440 if sunset is None else (sunset + 30) // 60)
+    with open(path, 'wb') as f:
+        f.write(struct.pack(_HEADER, _MAGIC, round(latitude * 10000), round(longitude * 10000)))
+        f.write(table)
+
+
+class SunsetHandler:
+
+    def __init__(self, sunset_config, event_handler=None):
+        self.table = None
+        self.event_handler = event_handler
+        self.sleep = asyncio.sleep  # replaced by hoymiles.usleep.NightSleep
+        self._day = None  # table index of sunrise, sunset
+        self.sunrise = None
+        self.sunset = None
+        if sunset_config and not sunset_config.get('disabled', False):
+            latitude = sunset_config.get('latitude')
+            longitude = sunset_config.get('longitude')
+            table = sunset_config.get('table', 'suntimes.bin')
+            if not self._check_table(table, latitude, longitude):
+                print(f'Computing sunrise/sunset table {table} for lat={latitude}, lon={longitude}')
+                try:
+                    build_table(latitude, longitude, table)
+                except (ImportError, OSError) as e:
+                    print('Sunset disabled.', e)
+                    return
+            self.table = table
+            sunrise, sunset = self._lookup(time.gmtime())
+            print(f'Todays sunset is at {_hhmm(sunset)} UTC, sunrise is at {_hhmm(sunrise)} UTC')
+            self._send_suntimes_event('info', f'ts={time.localtime()[3:5]}', _hhmm(sunrise), _hhmm(sunset))
+        else:
+            print('Sunset disabled. See config')
+
+    async def checkWaitForSunrise(self):
+        if not self.table:
+            return
+        time_to_sleep = 0
+        t = time.gmtime()
+        now = t[3] * 60 + t[4]
+        sunrise, sunset = self._lookup(t)
+        if sunset < now:  # after sunset
+            # wait until the sun rises again. if it's already after midnight, this will be today
+            sunrise, sunset = self._lookup(time.gmtime(time.time() + 86400), cache=False)
+            time_to_sleep = (sunrise + 24 * 60 - now) * 60
+        elif sunrise > now:  # before sunrise
+            time_to_sleep = (sunrise - now) * 60
+
+        if time_to_sleep > 0:
+            sunrise_time = _hhmm(sunrise)
+            sunset_time = _hhmm(sunset)
+            print(f'Next sunrise is at {sunrise_time} UTC, next sunset at {sunset_time} UTC')
+            print(f'Wake up in {time_to_sleep // 3600:02d} hours {(time_to_sleep // 60) % 60:02d} min.')
+            self._send_suntimes_event('sleeping', time_to_sleep, sunrise_time, sunset_time)
+            await self.sleep(time_to_sleep)
+            print('Woke up...')
+            self._send_suntimes_event('wakeup', time_to_sleep, sunrise_time, sunset_time)
+
+    def _lookup(self, t, cache=True):
+        # sunrise, sunset in minutes after midnight UTC of date t (time.gmtime())
+        year, day = t[0], t[7] - 1
+        if day >= 59 and (year % 4 or (year % 100 == 0 and year % 400)):
+            day += 1  # table of leap year, skip Feb 29th
+        if day == self._day:
+            return self.sunrise, self.sunset
+        with open(self.table, 'rb') as f:
+            f.seek(_HEADER_SIZE + 4 * day)
+            sunrise, sunset = struct.unpack('<HH', f.read(4))
+        if cache:
+            self._day, self.sunrise, self.sunset = day, sunrise, sunset
+        return sunrise, sunset
+
+    @staticmethod
+    def _check_table(table, latitude, longitude):
+        # table exists and was computed for the location
+        try:
+            with open(table, 'rb') as f:
+                magic, lat, lon = struct.unpack(_HEADER, f.read(_HEADER_SIZE))
+        except (OSError, ValueError):
+            return False
+        return magic == _MAGIC and lat == round(latitude * 10000) and lon == round(longitude * 10000)
+
+    def _send_suntimes_event(self, msg, st, srt, sst):
+        if self.event_handler:
+            self.event_handler({'event_type': f'suntimes.{msg}', 'sleeping_time': st, 'sunrise': srt, 'sunset': sst})
+
+
+def _hhmm(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build sunrise/sunset table for tablesunsethandler')
+    parser.add_argument('latitude', type=float)
+    parser.add_argument('longitude', type=float)
+    parser.add_argument('-o', '--output', default='suntimes.bin', help='table file (default: suntimes.bin)')
+    args = parser.parse_args()
+    build_table(args.latitude, args.longitude, args.output)
+    print(f'{args.output}: lat={args.latitude}, lon={args.longitude}')
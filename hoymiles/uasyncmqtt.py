@@ -0,0 +1,163 @@
+"""
+Non-blocking MQTT publisher for the asyncio event loop (Micropython and CPython)
+"""
+
+import asyncio
+import struct
+import time
+import hoymiles.log as log
+
+
+class MQTTPublisher:
+    """
+    Minimal asyncio MQTT 3.1.1 publisher (QoS 0) for Micropython.
+
+    publish() only enqueues. Messages are sent by the run() task, which also handles
+    reconnects with backoff and keepalive pings, so a slow or unreachable broker never
+    blocks the event loop.
+    """
+
+    def __init__(self, client_id, server, port=1883, user=None, password=None, keepalive=60, queue_size=64,
+                 max_backoff=60):
+        self.client_id = client_id if isinstance(client_id, bytes) else str(client_id).encode()
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.queue_size = queue_size
+        self.max_backoff = max_backoff
+
+        self.queue = []
+        self.connected = False
+        # counters
+        self.published = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+        self._reader = None
+        self._writer = None
+        self._rx_task = None
+        self._last_rx = 0
+        self._last_ping = 0
+        self._event = asyncio.Event()
+
+    @property
+    def queue_depth(self):
+        return len(self.queue)
+
+    def publish(self, topic, msg, retain=False):
+        if len(self.queue) >= self.queue_size:
+            self.queue.pop(0)  # drop oldest message
+            self.dropped += 1
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        elif not isinstance(msg, bytes):
+            msg = bytes(msg)  # copy memoryview of a reused buffer
+        self.queue.append((topic, msg, retain))
+        self._event.set()
+
+    async def run(self):
+        backoff = 1
+        while True:
+            try:
+                await self._connect()
+                log.info('mqtt connected to %s', self.server)
+                backoff = 1
+                await self._send_loop()
+            except Exception as e:
+                log.warning('mqtt connection error: %s', e)
+            await self._close()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+            self.reconnects += 1
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.server, self.port)
+
+        flags = 0x02  # clean session
+        payload = struct.pack('>H', len(self.client_id)) + self.client_id
+        if self.user:
+            flags |= 0x80
+            payload += struct.pack('>H', len(self.user)) + self.user.encode()
+            if self.password:
+                flags |= 0x40
+                payload += struct.pack('>H', len(self.password)) + self.password.encode()
+        variable_header = b'\x00\x04MQTT\x04' + struct.pack('>BH', flags, self.keepalive)
+
+        self._writer.write(b'\x10' + self._remaining_length(len(variable_header) + len(payload)))
+        self._writer.write(variable_header)
+        self._writer.write(payload)
+        await self._writer.drain()
+
+        connack = await asyncio.wait_for(self._reader.read(4), 10)
+        if len(connack) < 4 or connack[0] != 0x20 or connack[3] != 0:
+            raise OSError(f'connect refused {connack}')
+        self.connected = True
+        self._last_rx = self._last_ping = time.time()
+        self._rx_task = asyncio.create_task(self._read_loop())
+
+    async def _send_loop(self):
+        while self.connected:
+            try:
+                await asyncio.wait_for(self._event.wait(), max(1, self.keepalive // 2))
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            if not self.connected:
+                break
+            while self.queue:
+                topic, msg, retain = self.queue[0]
+                self._writer.write(struct.pack('B', 0x31 if retain else 0x30) +
+                                   self._remaining_length(2 + len(topic) + len(msg)) +
+                                   struct.pack('>H', len(topic)) + topic)
+                self._writer.write(msg)
+                await self._writer.drain()
+                self.queue.pop(0)
+                self.published += 1
+            now = time.time()
+            if now - self._last_rx > self.keepalive * 3 // 2:
+                raise OSError('keepalive timeout')
+            # ping from the last ping or broker packet, QoS 0 publishes are not answered
+            if now - max(self._last_ping, self._last_rx) >= self.keepalive // 2:
+                self._writer.write(b'\xc0\x00')  # PINGREQ
+                await self._writer.drain()
+                self._last_ping = now
+
+    async def _read_loop(self):
+        # consume broker packets (CONNACK, PINGRESP) and detect closed connections
+        try:
+            while True:
+                data = await self._reader.read(64)
+                if not data:
+                    break
+                self._last_rx = time.time()
+        except Exception:
+            pass
+        self.connected = False
+        self._event.set()
+
+    async def _close(self):
+        self.connected = False
+        if self._rx_task:
+            self._rx_task.cancel()
+            self._rx_task = None
+        if self._writer:
+            try:
+                self._writer.close()
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        self._reader = self._writer = None
+
+    @staticmethod
+    def _remaining_length(length):
+        b = bytearray()
+        while True:
+            digit = length % 128
+            length //= 128
+            b.append(digit | 0x80 if length else digit)
+            if not length:
+                return b
@@ -1,8 +1,10 @@
-from datetime import datetime, timezone, timedelta
+from datetime import timedelta
 import framebuf
-from time import sleep
 import time
-import logging
+import asyncio
+import hoymiles.log as log
+
+from hoymiles.webdata import WebPlugin  # noqa: F401, moved to portable module
 
 
 class DisplayPlugin:
@@ -10,6 +12,7 @@ class DisplayPlugin:
     display_width = 128  # default
     font_size = 8     # fontsize fix 8 + 2 pixel
     symbol_size = 10  # symbols fix 10x10 pixel
+    large_scale = 2   # scale of the power value
     last_ip = None
 
     # symbols 10x10 created with https://www.piskelapp.com/ converted png with gimp to 1 bit b/w pbm files
@@ -21,6 +24,12 @@ class DisplayPlugin:
                'blank': bytearray([0x00] * 20)}
 
     def __init__(self, config, **params):
+        self._slot_text = {}  # slot -> text shown
+        self._glyphs = {}     # char -> pre-scaled FrameBuffer
+        self._dirty_lo = 255  # range of display pages changed since last flush
+        self._dirty_hi = -1
+        self._static = False  # symbols drawn
+
         def _text_scaled(screen, text, x, y, scale, character_width=8, character_height=8):
             # temporary buffer for the text
             width = character_width * len(text)
@@ -93,20 +102,21 @@ class DisplayPlugin:
 
             self.display.fill(0)
             fscale = 2
-            try:
-                import hoymiles.ulogo as ulogo
-                self.display.invert(display_type == 'i2c-oled')
-                ulogo.show_logo(self.display)
-                self.display.text_scaled("MPY", 60, 14 - self.font_size, fscale)
-                self.display.text_scaled("DTU", 60, 34 - self.font_size, fscale)
-                import sys
-                import gc
-                del sys.modules['hoymiles.ulogo']
-                del ulogo
-                gc.collect()
-            except ImportError:
-                splash = "mpDTU"  # "Ahoy!"
-                self.display.text_scaled(splash, ((self.display_width - len(splash)*self.font_size*fscale) // 2), (self.display_height // 2) - self.font_size, fscale)
+            if params.get('splash', True):  # no splash screen on resume after deep sleep
+                try:
+                    import hoymiles.ulogo as ulogo
+                    self.display.invert(display_type == 'i2c-oled')
+                    ulogo.show_logo(self.display)
+                    self.display.text_scaled("MPY", 60, 14 - self.font_size, fscale)
+                    self.display.text_scaled("DTU", 60, 34 - self.font_size, fscale)
+                    import sys
+                    import gc
+                    del sys.modules['hoymiles.ulogo']
+                    del ulogo
+                    gc.collect()
+                except ImportError:
+                    splash = "mpDTU"  # "Ahoy!"
+                    self.display.text_scaled(splash, ((self.display_width - len(splash)*self.font_size*fscale) // 2), (self.display_height // 2) - self.font_size, fscale)
             self.display.show()
 
         except Exception as e:
@@ -118,11 +128,20 @@ class DisplayPlugin:
         if data is None or data.get('FW_HW_ID'):  # no valid data or HardwareResponse
             print("Invalid response!")
             return
+        if 'alarms' in data:  # EventsResponse, nothing to display
+            return
 
-        if self.display:
+        if self.display and not self._static:
+            # replace splash screen, symbols are drawn once
             self.display.fill(0)
             self.display.invert(0)
-            self.display.show()
+            self._slot_text.clear()
+            self._dirty(0, self.display_height)
+            self.show_symbol(0, 'level')
+            self.show_symbol(0, 'wifi', x=self.display_width-self.symbol_size)
+            self.show_symbol(1, "cal", x=16)
+            self.show_symbol(2, "sum", x=16)
+            self._static = True
 
         phase_sum_power = 0
         if data.get('phases'):
@@ -131,44 +150,96 @@ class DisplayPlugin:
                     phase_sum_power += phase['power']
         # self.show_value(0, f"     {phase_sum_power} W")
         self.show_value(0, f"{phase_sum_power:0.0f}W", center=True, large=True)
-        self.show_symbol(0, 'level')
-        self.show_symbol(0, 'wifi', x=self.display_width-self.symbol_size)
         if data.get('yield_today') is not None:
             yield_today = data['yield_today']
             self.show_value(1, f"{yield_today} Wh", x=40)  # 16+3*8
-            self.show_symbol(1, "cal", x=16)
         if data.get('yield_total'):
             yield_total = round(data['yield_total'] / 1000)
-            self.show_value(2, f"     {yield_total:01d} kWh")
-            self.show_symbol(2, "sum", x=16)
+            self.show_value(2, f"{yield_total:01d} kWh", x=40)
         if data.get('time'):
             timestamp = data['time']  # datetime.isoformat()
             Y, M, D, h, m, s, us, tz, fold = timestamp.tuple()
             self.show_value(3, f' {D:02d}.{M:02d} {h:02d}:{m:02d}:{s:02d}')
         if self.last_ip:
             self.show_value(4, self.last_ip, center=True)
+        self.flush()
 
     def show_value(self, slot, value, x=None, y=None, center=False, large=False):
+        """Draw value into slot if changed, call flush() to update the display"""
         if self.display is None:
-            print(value)
+            log.debug('display %s: %s', slot, value)
             return
+        if self._slot_text.get(slot) == value:
+            return
+        self._slot_text[slot] = value
         x, y = self._slot_pos(slot, x, y, length=len(value) if center else None)
         if large:
-            _scale = 2
-            self.display.text_scaled(value, x - _scale*self.font_size, y, _scale)
+            # clear area between the symbols
+            height = self.font_size * self.large_scale
+            self.display.fill_rect(self.symbol_size, y, self.display_width - 2 * self.symbol_size, height, 0)
+            self._text_large(value, x - self.large_scale*self.font_size, y)
+            self._dirty(y, height)
         else:
-            self.display.fill_rect(x, y, self.display_width, self.font_size, 0)  # clear data on display
+            self.display.fill_rect(0 if center else x, y, self.display_width, self.font_size, 0)  # clear data on display
             self.display.text(value, x, y, 1)
-        self.display.show()
+            self._dirty(y, self.font_size)
 
     def show_symbol(self, slot, sym, x=None, y=None):
+        """Draw symbol, call flush() to update the display"""
         if self.display is None:
             return
         data = self.symbols.get(sym)
         if data:
             x, y = self._slot_pos(slot, x, y)
             self.display.blit(framebuf.FrameBuffer(data, self.symbol_size, self.symbol_size, framebuf.MONO_HLSB), x, y)
-            self.display.show()
+            self._dirty(y, self.symbol_size)
+
+    def flush(self):
+        """Transfer changed display pages (SSD1306), other displays are updated completely"""
+        if self.display is None or self._dirty_hi < 0:
+            return
+        lo, hi = self._dirty_lo, self._dirty_hi
+        self._dirty_lo, self._dirty_hi = 255, -1
+        d = self.display
+        if hasattr(d, 'write_cmd') and hasattr(d, 'pages'):
+            x0 = (128 - d.width) // 2 if d.width != 128 else 0  # narrow displays use centred columns
+            for cmd in (0x21, x0, x0 + d.width - 1, 0x22, lo, hi):  # SET_COL_ADDR, SET_PAGE_ADDR
+                d.write_cmd(cmd)
+            d.write_data(memoryview(d.buffer)[lo * d.width:(hi + 1) * d.width])
+        else:
+            d.show()
+
+    def _dirty(self, y, height):
+        lo = max(y, 0) // 8
+        hi = min(y + height, self.display_height) - 1
+        if hi < 0:
+            return
+        hi //= 8
+        if lo < self._dirty_lo:
+            self._dirty_lo = lo
+        if hi > self._dirty_hi:
+            self._dirty_hi = hi
+
+    def _glyph(self, char):
+        # pre-scaled 8x8 font character, built on first use
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            size = self.font_size * self.large_scale
+            src = framebuf.FrameBuffer(bytearray(self.font_size), self.font_size, self.font_size, framebuf.MONO_VLSB)
+            src.text(char, 0, 0, 1)
+            glyph = framebuf.FrameBuffer(bytearray(size * size // 8), size, size, framebuf.MONO_VLSB)
+            for i in range(self.font_size):
+                for j in range(self.font_size):
+                    if src.pixel(i, j):
+                        glyph.fill_rect(i * self.large_scale, j * self.large_scale, self.large_scale, self.large_scale, 1)
+            self._glyphs[char] = glyph
+        return glyph
+
+    def _text_large(self, text, x, y):
+        size = self.font_size * self.large_scale
+        for char in text:
+            self.display.blit(self._glyph(char), x, y)
+            x += size
 
     def _slot_pos(self, slot, x=None, y=None, length=None):
         x = x if x else ((self.display_width - length*self.font_size) // 2) if length else 0
@@ -187,9 +258,23 @@ class DisplayPlugin:
             self.show_symbol(slot=0, sym='wifi', x=self.display_width-self.symbol_size)
             self.show_value(4, event.get('ip', ""), center=True)
             self.last_ip = event.get('ip', "")
+        self.flush()
 
 
 class MqttPlugin:
+    # (field id, topic name) pairs used to build the per inverter topic tables
+    _global_topics = (('hardware', 'hardware'), ('firmware', 'firmware'), ('time', 'time'), ('json', 'json'),
+                      ('alarm', 'alarm'),
+                      ('temperature', 'Temp'), ('P_DC', 'total/P_DC'), ('P_AC', 'total/P_AC'),
+                      ('event_count', 'total/total_events'), ('powerfactor', 'total/PF_AC'),
+                      ('yield_total', 'total/YieldTotal'), ('yield_today', 'total/YieldToday'),
+                      ('efficiency', 'total/Efficiency'))
+    _phase_topics = (('voltage', 'U_AC'), ('current', 'I_AC'), ('power', 'P_AC'), ('reactive_power', 'Q_AC'),
+                     ('frequency', 'F_AC'))
+    _string_topics = (('voltage', 'U_DC'), ('current', 'I_DC'), ('power', 'P_DC'), ('energy_daily', 'YieldDay'),
+                      ('energy_total', 'YieldTotal'), ('irradiation', 'Irradiation'))
+    reconnect_interval = 30  # seconds between reconnects of the umqtt client while messages are spooled
+
     def __init__(self, config, **params):
         print("mqtt plugin", config)
         self.start_time = time.time()
@@ -197,23 +282,62 @@ class MqttPlugin:
         self.topic_root = params.get('topic', params.get('topic', 'mpy-dtu'))
         self.dry_run = config.get('dry_run', False)
         self.client = None
+        self.online = True  # umqtt client: last publish succeeded
+        self._t_reconnect = 0
+        self.topic_tables = {}
+        # 'topics' (default): one topic per value, 'json': one document per inverter and poll
+        self.json_writer = None
+        self.legacy_topics = config.get('legacy_topics', False)  # json mode: publish power/yield topics too
+        self.alarm_writer = None  # created on the first alarm
+        if config.get('format', 'topics') == 'json':
+            from hoymiles.jsonwriter import JsonWriter
+            self.json_writer = JsonWriter()
+
+        # optional store-and-forward spool (flash ring) for broker outages
+        self.spool = None
+        spool_config = config.get('spool')
+        if spool_config:
+            from hoymiles.spool import Spool
+            self.replay_rate = spool_config.get('replay_rate', 20)  # messages replayed per poll
+            self.spool = Spool(spool_config.get('path', '/spool'),
+                               segment_size=spool_config.get('segment_size', 4096),
+                               max_segments=spool_config.get('max_segments', 8),
+                               batch_size=spool_config.get('batch_size', 1024))
+
+        from machine import unique_id
+        from ubinascii import hexlify
+        mqtt_broker = config.get('host', '127.0.0.1')
+
+        if config.get('client', 'async') == 'async':
+            # non-blocking: store_status() and on_event() only enqueue, messages are sent by an asyncio task
+            from hoymiles.uasyncmqtt import MQTTPublisher
+            self.client = MQTTPublisher(hexlify(unique_id()), mqtt_broker, port=config.get('port', 1883),
+                                        user=config.get('user'), password=config.get('password'),
+                                        keepalive=config.get('keepalive', 60), queue_size=config.get('queue_size', 64))
+            asyncio.create_task(self.client.run())
+            return
 
         try:
-            from umqtt.robust import MQTTClient
+            if self.spool:
+                # robust client blocks in publish() until reconnected, the spool takes the messages instead
+                from umqtt.simple import MQTTClient
+            else:
+                from umqtt.robust import MQTTClient
         except ImportError:
             print('Install module with command: \nmpremote mip install umqtt.simple\nmpremote mip install umqtt.robust')
             return
+        mqtt_client = MQTTClient(hexlify(unique_id()), mqtt_broker)
         try:
-            from machine import unique_id
-            from ubinascii import hexlify
-            mqtt_broker = config.get('host', '127.0.0.1')
-            mqtt_client = MQTTClient(hexlify(unique_id()), mqtt_broker)
             mqtt_client.connect()
             print("connected to ", mqtt_broker)
             self.client = mqtt_client
         except OSError as e:
             print("MQTT disabled. network error?:", e)
-            logging.exception(e)
+            log.exception(e)
+            if self.spool:  # spool until reconnected
+                self.client = mqtt_client
+                self.online = False
+                self._t_reconnect = time.time()
 
     def store_status(self, response, **params):
         data = response.to_dict() if callable(getattr(response, 'to_dict', None)) else None
@@ -221,70 +345,113 @@ class MqttPlugin:
         if data is None:
             return
 
-        topic = params.get('topic', None)
-        if not topic:
-            topic = f'{self.topic_root}/{data.get("inverter_name", "hoymiles")}'
+        if self.spool and self.spool.depth and self._connected():
+            self.spool.replay(self._replay, self.replay_rate)
+
+        topics = self._topic_table(data, params.get('topic', None))
 
         if data.get('FW_HW_ID'):  # HardwareInfoResponse
-            self._publish(f'{topic}/hardware', f'{data["FW_HW_ID"]}')
-            self._publish(f'{topic}/firmware',
+            self._publish(topics['hardware'], f'{data["FW_HW_ID"]}')
+            self._publish(topics['firmware'],
                           f'v{data.get("FW_ver_maj","")}.{data.get("FW_ver_min","")}.{data.get("FW_ver_pat", "")}' +
                           f'@{data.get("FW_build_yy","")}.{data.get("FW_build_mm", "")}.{data.get("FW_build_dd", "")}T{data.get("FW_build_HH","")}:{data.get("FW_build_MM","")}')
+        elif 'alarms' in data:  # EventsResponse, new alarms only
+            if self.alarm_writer is None:
+                from hoymiles.jsonwriter import JsonWriter
+                self.alarm_writer = JsonWriter(128)
+            for alarm in data['alarms']:
+                self._publish(topics['alarm'], self.alarm_writer.dump(alarm))
+        elif self.json_writer:  # StatusResponse as json document
+            self._publish(topics['json'], self.json_writer.dump(data))
+            if self.legacy_topics:  # same topics as outputs.MqttOutputPlugin
+                for phase, phase_topics in zip(data.get('phases') or [], topics['phases']):
+                    self._publish(phase_topics['power'], phase['power'])
+                if data.get('yield_total') is not None:
+                    self._publish(topics['yield_total'], data['yield_total'] / 1000)
+                if data.get('yield_today') is not None:
+                    self._publish(topics['yield_today'], data['yield_today'] / 1000)
         else:  # StatusResponse
             # Global Head
             if data.get('time'):
-                self._publish(f'{topic}/time', data['time'].isoformat())
+                self._publish(topics['time'], data['time'].isoformat())
 
             # AC Data
-            phase_id = 0
             phase_sum_power = 0
             phases_ac = data.get('phases')
             if phases_ac:
-                for phase in phases_ac:
-                    phase_name = f'ac/{phase_id}' if len(phases_ac) > 1 else 'ch0'
-                    self._publish(f'{topic}/{phase_name}/U_AC', phase['voltage'])
-                    self._publish(f'{topic}/{phase_name}/I_AC', phase['current'])
-                    self._publish(f'{topic}/{phase_name}/P_AC', phase['power'])
-                    self._publish(f'{topic}/{phase_name}/Q_AC', phase['reactive_power'])
-                    self._publish(f'{topic}/{phase_name}/F_AC', phase['frequency'])
-                    phase_id = phase_id + 1
+                for phase, phase_topics in zip(phases_ac, topics['phases']):
+                    self._publish(phase_topics['voltage'], phase['voltage'])
+                    self._publish(phase_topics['current'], phase['current'])
+                    self._publish(phase_topics['power'], phase['power'])
+                    self._publish(phase_topics['reactive_power'], phase['reactive_power'])
+                    self._publish(phase_topics['frequency'], phase['frequency'])
                     phase_sum_power += phase['power']
 
             # DC Data
-            string_id = 1
             string_sum_power = 0
             if data.get('strings'):
-                for string in data['strings']:
-                    string_name = f'ch{string_id}'
-                    if 'name' in string:
-                        s_name = string['name'].replace(" ", "_")
-                        self._publish(f'{topic}/{string_name}/name', s_name)
-                    self._publish(f'{topic}/{string_name}/U_DC', string['voltage'])
-                    self._publish(f'{topic}/{string_name}/I_DC', string['current'])
-                    self._publish(f'{topic}/{string_name}/P_DC', string['power'], )
-                    self._publish(f'{topic}/{string_name}/YieldDay', string['energy_daily'])
-                    self._publish(f'{topic}/{string_name}/YieldTotal', string['energy_total'] / 1000)
-                    self._publish(f'{topic}/{string_name}/Irradiation', string['irradiation'])
-                    string_id = string_id + 1
+                for string, string_topics in zip(data['strings'], topics['strings']):
+                    if 'name' in string_topics:
+                        self._publish(string_topics['name'], string_topics['s_name'])
+                    self._publish(string_topics['voltage'], string['voltage'])
+                    self._publish(string_topics['current'], string['current'])
+                    self._publish(string_topics['power'], string['power'], )
+                    self._publish(string_topics['energy_daily'], string['energy_daily'])
+                    self._publish(string_topics['energy_total'], string['energy_total'] / 1000)
+                    self._publish(string_topics['irradiation'], string['irradiation'])
                     string_sum_power += string['power']
 
             # Global
             if data.get('temperature'):
-                self._publish(f'{topic}/Temp', data['temperature'])
+                self._publish(topics['temperature'], data['temperature'])
 
             # Total
-            self._publish(f'{topic}/total/P_DC', string_sum_power)
-            self._publish(f'{topic}/total/P_AC', phase_sum_power)
+            self._publish(topics['P_DC'], string_sum_power)
+            self._publish(topics['P_AC'], phase_sum_power)
             if data.get('event_count'):
-                self._publish(f'{topic}/total/total_events', data['event_count'])
+                self._publish(topics['event_count'], data['event_count'])
             if data.get('powerfactor'):
-                self._publish(f'{topic}/total/PF_AC', data['powerfactor'])
+                self._publish(topics['powerfactor'], data['powerfactor'])
             if data.get('yield_total'):
-                self._publish(f'{topic}/total/YieldTotal', data['yield_total'] / 1000)
+                self._publish(topics['yield_total'], data['yield_total'] / 1000)
             if data.get('yield_today'):
-                self._publish(f'{topic}/total/YieldToday', data['yield_today'] / 1000)
+                self._publish(topics['yield_today'], data['yield_today'] / 1000)
             if data.get('efficiency'):
-                self._publish(f'{topic}/total/Efficiency', data['efficiency'])
+                self._publish(topics['efficiency'], data['efficiency'])
+
+    def _topic_table(self, data, topic=None):
+        # encoded topics keyed by field id, built once per inverter (phases and strings on first status response)
+        key = topic if topic else data.get('inverter_name', 'hoymiles')
+        topics = self.topic_tables.get(key)
+        if topics is None:
+            if not topic:
+                topic = f'{self.topic_root}/{key}'
+            topics = {'phases': [], 'strings': []}
+            for field_id, name in self._global_topics:
+                topics[field_id] = f'{topic}/{name}'.encode()
+            topics['root'] = topic
+            self.topic_tables[key] = topics
+
+        phases_ac = data.get('phases')
+        if phases_ac and not topics['phases']:
+            for phase_id in range(len(phases_ac)):
+                phase_name = f'ac/{phase_id}' if len(phases_ac) > 1 else 'ch0'
+                topics['phases'].append({field_id: f'{topics["root"]}/{phase_name}/{name}'.encode()
+                                         for field_id, name in self._phase_topics})
+
+        strings = data.get('strings')
+        if strings and not topics['strings']:
+            string_id = 1
+            for string in strings:
+                string_name = f'ch{string_id}'
+                string_topics = {field_id: f'{topics["root"]}/{string_name}/{name}'.encode()
+                                 for field_id, name in self._string_topics}
+                if 'name' in string:
+                    string_topics['name'] = f'{topics["root"]}/{string_name}/name'.encode()
+                    string_topics['s_name'] = string['name'].replace(" ", "_")
+                topics['strings'].append(string_topics)
+                string_id = string_id + 1
+        return topics
 
     def on_event(self, event, topic=None):
         if not event:
@@ -293,8 +460,9 @@ class MqttPlugin:
             topic = self.topic_root
         evtp = event.get('event_type', "")
         if "suntimes." in evtp:
-            self._publish(f'{topic}/sunset', event.get('sunset', ""))
-            self._publish(f'{topic}/sunrise', event.get('sunrise', ""))
+            if 'sunset' in event:  # not sent by the night detection
+                self._publish(f'{topic}/sunset', event['sunset'])
+                self._publish(f'{topic}/sunrise', event['sunrise'])
             if evtp == 'suntimes.sleeping':
                 self._publish(f'{topic}/status', 'sleeping')
             elif evtp == "suntimes.wakeup":
@@ -304,20 +472,80 @@ class MqttPlugin:
         else:
             uptime = str(timedelta(seconds=int(time.time() - self.start_time))).replace(' ', '')
             self._publish(f'{topic}/uptime', uptime)
+            if hasattr(self.client, 'queue_depth'):
+                self._publish(f'{topic}/mqtt/queue_depth', self.client.queue_depth)
+                self._publish(f'{topic}/mqtt/dropped', self.client.dropped)
+            if self.spool:
+                self._publish(f'{topic}/mqtt/spool_depth', self.spool.depth)
+                self._publish(f'{topic}/mqtt/spool_evictions', self.spool.evictions)
+                self._publish(f'{topic}/mqtt/spool_replay_rate', self.spool.replay_rate)
+
+    def _connected(self):
+        if self.client is None:
+            return False
+        if hasattr(self.client, 'connected'):  # MQTTPublisher
+            return self.client.connected
+        if not self.online and time.time() - self._t_reconnect >= self.reconnect_interval:
+            self._t_reconnect = time.time()
+            try:
+                self.client.connect()
+                self.online = True
+            except OSError:
+                pass
+        return self.online
+
+    def _replay(self, record):
+        from hoymiles.spool import unpack_message
+        topic, value = unpack_message(record)
+        try:
+            self.client.publish(topic, value)
+        except OSError:
+            self.online = False
+            return False
+        return True
 
     def _publish(self, topic, value):
-        if self.dry_run or self.client is None:
-            print(topic, str(value))
+        if not isinstance(value, (bytes, memoryview)):
+            value = str(value)
+        if self.dry_run:
+            print(topic, bytes(value) if isinstance(value, memoryview) else value)
+        elif self.spool and not self._connected():
+            from hoymiles.spool import pack_message
+            self.spool.append(pack_message(topic, value))
+        elif self.client is None:
+            if log.enabled(log.DEBUG):
+                log.debug('mqtt %s %s', topic, bytes(value) if isinstance(value, memoryview) else value)
         else:
-            self.client.publish(topic.encode(), str(value))
+            try:
+                self.client.publish(topic if isinstance(topic, bytes) else topic.encode(), value)
+            except OSError:  # umqtt client lost the connection
+                if not self.spool:
+                    raise
+                from hoymiles.spool import pack_message
+                self.online = False
+                self._t_reconnect = time.time()
+                self.spool.append(pack_message(topic, value))
 
 
 class BlinkPlugin:
+    """
+    Blink LED / NeoPixel without blocking the event loop.
+
+    Blinks are queued and played by an asyncio task, a burst of equal blinks
+    is coalesced into one.
+    """
+    on_time = 0.05   # seconds led is on
+    off_time = 0.05  # seconds led stays off after a blink
+    queue_size = 4
+
     def __init__(self, config, **params):
         led_pin = config.get('led_pin')
         self.high_on = not config.get('inverted', False)
         self.np = None
         self.led = None
+        self.queue = []  # pending blink colors
+        self._event = asyncio.Event()
+        self._task = None
         if led_pin is None:
             print("blink disabled no led configured.")
         else:
@@ -329,49 +557,39 @@ class BlinkPlugin:
 
     def store_status(self, response, **params):
         if self.led is not None:
-            if self.np is not None:
-                self.np[0] = (255, 0, 0)
-                self.np.write()
-                sleep(0.05)
-                self.np[0] = (0, 0, 0)
-                self.np.write()
-            else:
-                self.led.value(self.high_on)
-                sleep(0.05)  # keep it short because it is blocking
-                self.led.value(not self.high_on)  # self.led.toggle() not always supported
+            self.blink((255, 0, 0))
 
     def on_event(self, event):
         if self.np and 'inverter.polling' in event.get('event_type', ""):
-            self.np[0] = (0, 16, 0)
+            self.blink((0, 16, 0))
+
+    def blink(self, color):
+        """
+        Queue blink, returns immediately (call within running event loop)
+
+        :param tuple color: NeoPixel (r, g, b), plain leds just blink
+        """
+        if color in self.queue or len(self.queue) >= self.queue_size:
+            return  # coalesce bursts
+        self.queue.append(color)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._event.set()
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            while self.queue:
+                self._set(self.queue[0])
+                await asyncio.sleep(self.on_time)
+                self._set(None)
+                self.queue.pop(0)
+                await asyncio.sleep(self.off_time)
+
+    def _set(self, color):
+        if self.np is not None:
+            self.np[0] = color if color else (0, 0, 0)
             self.np.write()
-            sleep(0.05)
-            self.np[0] = (0, 0, 0)
-            self.np.write()
-
-
-class WebPlugin:
-    last_response = {'time': datetime.now(timezone.utc), 'inverter_name': 'unkown', 'phases': [{}], 'strings': [{}]}
-    last_event = {}
-
-    def __init__(self, config={}, **params):
-        if config:
-            self.last_response['inverter_name'] = config.get('name', 'unkown')
-            self.last_response['strings'] = [{'name': e.get('s_name', "panel")} for e in config.get('strings', [])]
-
-    def store_status(self, response, **params):
-        data = response.to_dict() if callable(getattr(response, 'to_dict', None)) else None
-        if data and not data.get('FW_HW_ID'):  # no valid data or HardwareResponse
-            self.last_response = data
-
-    def get_data(self):
-        _last = self.last_response
-        _last['event'] = self.last_event
-        _timestamp = _last['time']
-        if isinstance(_timestamp, datetime):
-            _new_ts = _timestamp.isoformat().split('.')[0]
-            _last['time'] = _new_ts
-        return f"{_last}".replace('\'', '\"')
-
-    def on_event(self, event):
-        if 'suntimes' in event.get('event_type', ""):
-            self.last_event = event
+        else:
+            self.led.value(self.high_on if color else not self.high_on)  # self.led.toggle() not always supported
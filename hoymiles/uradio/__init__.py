@@ -9,6 +9,7 @@ except ImportError:
     from .nrf24 import RF24
 
 from hoymiles import HOYMILES_DEBUG_LOGGING, hexify_payload
+import hoymiles.log as log
 
 # https://github.com/nRF24/RF24/blob/3bbcce8d18b32be0b350978472b53830e3ad1285/nRF24L01.h
 
@@ -42,8 +43,8 @@ class HoymilesNRF:
     def transmit(self, packet, txpower=None):
         self.next_tx_channel()
 
-        if HOYMILES_DEBUG_LOGGING:
-            print(f'Transmit {len(packet)} bytes channel {self.tx_channel}: {hexify_payload(packet)}')
+        if HOYMILES_DEBUG_LOGGING and log.enabled(log.DEBUG):
+            log.debug('Transmit %d bytes channel %d: %s', len(packet), self.tx_channel, hexify_payload(packet))
 
         inv_esb_addr = b'\01' + packet[1:5]
         dtu_esb_addr = b'\01' + packet[5:9]
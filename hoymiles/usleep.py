@@ -0,0 +1,94 @@
+"""
+Night sleep for battery and solar powered DTUs (Micropython only)
+
+Replaces the asyncio.sleep() of the sunset handler until sunrise: the DTU state
+is saved, nRF24, WiFi and display are powered down and the board sleeps with
+machine.deepsleep() (reset on wake up, main.py is started again) or
+machine.lightsleep() (program continues). The state is kept with
+hoymiles.statestore (config 'state' of the dtu or 'state' of the sleep config),
+after a deep sleep reset the splash screen is skipped.
+
+Usage::
+
+    night_sleep = NightSleep(ahoy_config.get('sleep'))   # {'mode': 'deep'}
+    display = DisplayPlugin(display_config, splash=not night_sleep.resumed)
+    dtu = HoymilesDTU(...)
+    night_sleep.attach(dtu, display=display, feed=watchdog_timer.feed)
+"""
+
+import asyncio
+import machine
+
+_CHUNK_MS = 30000  # lightsleep chunk, watchdog fed in between
+
+
+class NightSleep:
+
+    def __init__(self, config):
+        """
+        :param dict config: mode 'deep' or 'light', state (file, if the dtu has no state store),
+                            min_time (shorter nights are slept awake),
+                            grace (seconds for outputs to send the sleeping event)
+        """
+        self.mode = config.get('mode', 'light')
+        self.state_file = config.get('state', 'dtu_state.bin')
+        self.min_time = config.get('min_time', 600)
+        self.grace = config.get('grace', 5)
+        self.resumed = machine.reset_cause() == machine.DEEPSLEEP_RESET
+        self.dtu = None
+        self.display = None
+        self.feed = None
+
+    def attach(self, dtu, display=None, feed=None):
+        """
+        Take over the night sleep of the dtu's sunset handler, restore state
+
+        :param hoymiles.HoymilesDTU dtu: dtu
+        :param display: DisplayPlugin (optional)
+        :param feed: watchdog feed function (optional, light sleep)
+        """
+        self.dtu = dtu
+        self.display = display
+        self.feed = feed
+        if dtu.sunset:
+            dtu.sunset.sleep = self.sleep
+        if dtu.state is None:
+            from hoymiles.statestore import StateStore
+            dtu.attach_state(StateStore(self.state_file))
+
+    async def sleep(self, seconds):
+        if seconds < self.min_time:
+            await asyncio.sleep(seconds)
+            return
+        await asyncio.sleep(self.grace)  # let outputs send the sleeping event
+        ms = (seconds - self.grace) * 1000
+        self.dtu.save_state(force=True)
+        self.power_down()
+        print(f'{self.mode} sleep for {ms // 1000} s')
+        if self.mode == 'deep':
+            machine.deepsleep(ms)  # does not return
+        while ms > 0:
+            machine.lightsleep(min(ms, _CHUNK_MS))
+            ms -= _CHUNK_MS
+            if self.feed:
+                self.feed()
+        self.power_up()
+
+    def power_down(self):
+        if self.dtu.hmradio:
+            self.dtu.hmradio.radio.power = False
+        if self.display and self.display.display and hasattr(self.display.display, 'poweroff'):
+            self.display.display.poweroff()
+        import network
+        network.WLAN(network.STA_IF).active(False)
+
+    def power_up(self):
+        if self.dtu.hmradio:
+            self.dtu.hmradio.radio.power = True
+        if self.display and self.display.display and hasattr(self.display.display, 'poweron'):
+            self.display.display.poweron()
+        try:
+            import wlan
+            wlan.do_connect()
+        except Exception as e:
+            print('wifi not connected', e)
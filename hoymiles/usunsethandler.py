@@ -7,6 +7,7 @@ class SunsetHandler:
     def __init__(self, sunset_config, event_handler=None):
         self.suntimes = None
         self.event_handler = event_handler
+        self.sleep = asyncio.sleep  # replaced by hoymiles.usleep.NightSleep
         if sunset_config and not sunset_config.get('disabled', False):
             # (49.453872, 11.077298)
             latitude = sunset_config.get('latitude')
@@ -43,7 +44,7 @@ class SunsetHandler:
             h, m = divmod(time_to_sleep//60, 60)
             print(f'Wake up in {h:02d} hours {m:02d} min.')
             self._send_suntimes_event('sleeping', time_to_sleep, sunrise_time, sunset_time)
-            await asyncio.sleep(time_to_sleep)
+            await self.sleep(time_to_sleep)
             print(f'Woke up...')
             self._send_suntimes_event('wakeup', time_to_sleep, sunrise_time, sunset_time)
 
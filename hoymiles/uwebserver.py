@@ -1,7 +1,40 @@
+import sys
 import asyncio
-import network
 from datetime import datetime, timezone
-import time
+import os
+import hoymiles.log as log
+
+try:
+    import network
+except ImportError:  # CPython, no wifi setup
+    network = None
+
+if sys.implementation.name == "micropython":
+    def _encode(data): return data  # streams accept str
+
+    def _readinto(reader, buf): return reader.readinto(buf)
+else:
+    def const(x): return x
+
+    def _encode(data):
+        if isinstance(data, str):
+            return data.encode()
+        if isinstance(data, memoryview):
+            return data.cast('B')  # the transport slices partial sends by item, not by byte
+        return data
+
+    async def _readinto(reader, buf):
+        data = await reader.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+_CHUNK_SIZE = const(512)
+_MAX_AGE = const(86400)  # Cache-Control max-age of css/js in seconds
+_KEEPALIVE = const(30)   # seconds between event stream keepalive comments
+_REQUEST_SIZE = const(1024)  # maximum size of request line and headers
+_TIMEOUT = const(5)      # seconds to receive the request or to send a chunk of the response
+_IDLE = const(2)         # seconds a keep-alive connection waits for the next request
+_BUSY = const(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\nConnection: close\r\n\r\n')
 
 _CSS = const("""
 :root {
@@ -115,7 +148,18 @@ const spec = {
 const specMap = new Map(Object.entries(spec));
 
 document.addEventListener('DOMContentLoaded', function() {
-    window.setInterval(updateContent, 10000);
+    if (window.EventSource) {
+        // pushed by the dtu after each poll
+        const events = new EventSource('/events');
+        events.onmessage = event => showData(JSON.parse(event.data));
+        events.onerror = () => {
+            if (events.readyState == EventSource.CLOSED) {  // e.g. too many clients
+                window.setInterval(updateContent, 10000);
+            }
+        };
+    } else {
+        window.setInterval(updateContent, 10000);
+    }
 });
 function updateContent() {
     fetch(window.location + 'data')
@@ -125,9 +169,6 @@ function updateContent() {
 
 
 function showData(json) {
-    let values = [json]
-    json.power = json.phases[0].power;
-
     const content = document.getElementById('content');
     if (json.event['event_type'] == 'suntimes.sleeping') {
         theme = 'dark';
@@ -136,12 +177,10 @@ function showData(json) {
     }
     content.setAttribute('data-theme', theme);
     content.innerText = ''; // clear node first
-    renderTable(content, values, json.inverter_name + ' ' + json.time + '\\n ' + new Date(), 'hd1', 'cl1');
-    json.strings.forEach(item => {
-        strNde = div('half');
-        content.appendChild(strNde);
-        renderTable(strNde, [item], item.name, 'hd2', 'cl2');
-    })
+    if (json.inverters.length > 1) {
+        renderTable(content, [json.totals], 'Total ' + json.totals.time + '\\n ' + new Date(), 'hd1', 'cl1');
+    }
+    json.inverters.forEach(inverter => showInverter(content, inverter));
 
     const footer = document.getElementById('footer');
     footer.className = 'footer'
@@ -156,6 +195,16 @@ function showData(json) {
     }
 };
 
+function showInverter(content, json) {
+    json.power = json.phases[0].power;
+    renderTable(content, [json], json.inverter_name + ' ' + json.time + '\\n ' + new Date(), 'hd1', 'cl1');
+    json.strings.forEach(item => {
+        strNde = div('half');
+        content.appendChild(strNde);
+        renderTable(strNde, [item], item.name, 'hd2', 'cl2');
+    })
+}
+
 function div(cssClass) {
     let div =  document.createElement('div');
     div.className = cssClass;
@@ -227,88 +276,378 @@ _HTML = const("""
 """)
 
 
+def _stat_asset(file, gzipped):
+    # (file, gzipped, etag, size) or False if file does not exist, etag from size and mtime
+    try:
+        st = os.stat(file)
+    except OSError:
+        return False
+    return file, gzipped, f'"{st[6]:x}-{st[8]:x}{"-gz" if gzipped else ""}"', st[6]
+
+
+class Request:
+    """Parsed request line and the headers used by WebServer"""
+
+    def __init__(self, method, path, query=None, if_none_match=None, accept_gzip=False, keep_alive=False):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.if_none_match = if_none_match
+        self.accept_gzip = accept_gzip
+        self.keep_alive = keep_alive
+        self.rest = b''  # bytes received after the headers (next pipelined request)
+
+
 class WebServer:
 
     dtu_data = {'last': {'time': datetime.now(timezone.utc), 'inverter_name': 'HM600', 'yield_total': 1305799.0, 'temperature': 18.6, 'powerfactor': 1.0, 'yield_today': 207.0, 'phases': [{'frequency': 50.01, 'current': 0.9599999, 'power': 226.3, 'voltage': 236.3}], 'efficiency': 95.49, 'strings': [{'energy_daily': 67, 'name': 'Panel1', 'power': 110.3, 'current': 3.06, 'energy_total': 580076, 'irradiation': 29.026, 'voltage': 36.1}, {'energy_daily': 140, 'name': 'Panel2', 'power': 126.7, 'current': 3.7, 'energy_total': 725723, 'irradiation': 33.342, 'voltage': 34.3}]}}
 
-    def __init__(self, data_provider=None, start_page=None, wifi_mode=network.STA_IF):
+    def __init__(self, data_provider=None, start_page=None, wifi_mode=network.STA_IF if network else None,
+                 static_dir='www', max_event_clients=2, max_clients=3, host=None, port=80):
+        """
+        :param data_provider: object with get_data(serial=None) returning json (bytes or str) of all inverters
+                              or of a single inverter (None if unknown), optional attribute
+                              changed (asyncio.Event set on new data) enables /events, history enables
+                              /history and get_metrics() enables /metrics
+        :param int max_event_clients: maximum number of connected /events clients
+        :param int max_clients: maximum number of connections handled at the same time (without /events)
+        :param str start_page: optional html file served as start page
+        :param wifi_mode: network.STA_IF or network.AP_IF (Micropython only)
+        :param str static_dir: directory with (gzip precompressed) static files, see make_webassets.py
+        :param str host: address to listen on (default: ip of the wifi interface, CPython: all interfaces)
+        :param int port: port to listen on
+        """
         if data_provider is None:
             self.data_provider = self
         else:
             self.data_provider = data_provider
         self.start_page = start_page
         self.wifi_mode = wifi_mode
+        self.host = host
+        self.port = port
+        self.static_dir = static_dir
+        self.max_event_clients = max_event_clients
+        self.event_clients = 0
+        self.max_clients = max_clients
+        self.clients = 0
+        self.rejected = 0
+        self.requests = 0
+        self._pool = [bytearray(_REQUEST_SIZE) for _ in range(max_clients)]  # request buffers
+        self.routes = {'/events': self._send_events,
+                       '/history': self._send_history,
+                       '/data': self._send_data,
+                       '/data/': self._send_data,
+                       '/metrics': self._send_metrics,
+                       '/log': self._send_log,
+                       '/style.css': self._send_css,
+                       '/script.js': self._send_js,
+                       '/favicon.ico': self._send_not_found}
         self.server = None
-
-    def get_data(self):
-        _last = self.dtu_data['last']
-        _timestamp = _last['time']
-        if isinstance(_timestamp, datetime):
-            _new_ts = _timestamp.isoformat().split('.')[0]
-            _last['time'] = _new_ts
-        return f"{_last}".replace('\'', '\"')
+        self._json = None
+        self._assets = {}  # (path, gzip accepted) -> (file, gzipped, etag, size) or False if not on flash at start
+        self._etags = {}   # path -> (etag, size) of built-in assets
+        self._buf = bytearray(_CHUNK_SIZE)
+
+    def get_data(self, serial=None):
+        if serial is not None:
+            return None
+        if self._json is None:  # static demo data, serialized once
+            from hoymiles.jsonwriter import JsonWriter
+            last = self.dtu_data['last']
+            totals = {'time': last['time'], 'inverters': 1, 'power': last['phases'][0]['power'],
+                      'yield_today': last['yield_today'], 'yield_total': last['yield_total']}
+            self._json = JsonWriter().dumps({'totals': totals, 'event': {}, 'inverters': [last]})
+        return self._json
+
+    def route(self, path, handler):
+        """
+        Add or replace route
+
+        :param str path: request path, a path ending with '/' matches all paths below (e.g. '/data/')
+        :param handler: coroutine function handler(request, writer)
+        """
+        self.routes[path] = handler
+
+    def metrics(self):
+        return {'clients': self.clients, 'event_clients': self.event_clients, 'requests': self.requests,
+                'rejected': self.rejected}
 
     async def serve_client(self, reader, writer):
-        start_time = time.ticks_us()
-        request_line = await reader.readline()
-        print("Request:", request_line)
-        # We are not interested in HTTP request headers, skip them
-        while await reader.readline() != b"\r\n":
+        if self.clients >= self.max_clients:
+            self.rejected += 1
+            writer.write(_BUSY)
+            await self._close(writer)
+            return
+        self.clients += 1
+        try:
+            request = await self._read_request(reader, writer)
+            while request:
+                self.requests += 1
+                path = request.path
+                log.debug('%s %s', request.method, path)
+                handler = self.routes.get(path) or self.routes.get(path[:path.rfind('/') + 1], self._send_page)
+                await handler(request, writer)
+                if not request.keep_alive:
+                    break
+                request = await self._read_request(reader, writer, idle=True, rest=request.rest)
+        except Exception:  # timeout or connection closed by client
+            self.rejected += 1
+        finally:
+            self.clients -= 1
+            await self._close(writer)
+
+    async def _read_request(self, reader, writer, idle=False, rest=b''):
+        """
+        Read request line and headers into a preallocated buffer
+
+        :param bool idle: waiting for the next request of a keep-alive connection
+        :param bytes rest: bytes received after the previous request of the connection
+        :return: parsed request or None if the request was answered with an error or the connection is closed
+        :rtype: Request
+        """
+        buf = self._pool.pop()
+        try:
+            mv = memoryview(buf)
+            n = len(rest)
+            mv[:n] = rest
+            start = 0  # search position of the end of the headers
+            while True:
+                end = bytes(mv[start:n]).find(b'\r\n\r\n')
+                if end >= 0:
+                    end += start + 4
+                    break
+                start = max(n - 3, 0)
+                if n == len(buf):
+                    await self._send(None, writer, 'text/html', '', status='431 Request Header Fields Too Large')
+                    return None
+                try:
+                    received = await asyncio.wait_for(_readinto(reader, mv[n:]), _IDLE if idle and not n else _TIMEOUT)
+                except asyncio.TimeoutError:
+                    if idle and not n:
+                        return None  # idle keep-alive connection
+                    raise
+                if not received:
+                    return None
+                n += received
+            head = bytes(mv[:end])
+            rest = bytes(mv[end:n])
+        finally:
+            self._pool.append(buf)
+
+        lines = head.split(b'\r\n')
+        parts = lines[0].split(b' ')
+        if len(parts) != 3:
+            await self._send(None, writer, 'text/html', '', status='400 Bad Request')
+            return None
+        if parts[0] != b'GET':
+            await self._send(None, writer, 'text/html', '', status='405 Method Not Allowed')
+            return None
+        path, _, query = parts[1].decode().partition('?')
+        request = Request('GET', path, query, keep_alive=parts[2] == b'HTTP/1.1')
+        request.rest = rest
+        for line in lines[1:]:
+            name = line[:16].lower()
+            if name.startswith(b'if-none-match:'):
+                request.if_none_match = line[14:].strip().decode()
+            elif name.startswith(b'accept-encoding:'):
+                request.accept_gzip = b'gzip' in line
+            elif name.startswith(b'connection:'):
+                request.keep_alive = b'keep-alive' in line.lower()
+        return request
+
+    def _connection(self, request, length_known=True):
+        # keep connection open if the client wants it, the body length is known and other clients can still connect
+        if request is None:
+            return 'Connection: close\r\n'
+        request.keep_alive = request.keep_alive and length_known and self.clients < self.max_clients
+        return 'Connection: keep-alive\r\n' if request.keep_alive else 'Connection: close\r\n'
+
+    @staticmethod
+    async def _drain(writer):
+        await asyncio.wait_for(writer.drain(), _TIMEOUT)  # do not wait forever for slow clients
+
+    @staticmethod
+    async def _close(writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
             pass
 
-        request = str(request_line)
-        if request.find('/data') == 6:
-            # print('=> data requested')
-            header = 'HTTP/1.1 200 OK\r\nContent-type: application/json\r\n\r\n'
-            json = self.data_provider.get_data()
-            response = f"{json}"
-        elif request.find('/style.css') == 6:
-            # print('=> css requested')
-            header = 'HTTP/1.1 200 OK\r\nContent-type: text/css\r\n\r\n'
-            response = _CSS
-        elif request.find('/script.js') == 6:
-            # print('=> css requested')
-            header = 'HTTP/1.1 200 OK\r\nContent-type: text/javascript\r\n\r\n'
-            response = _JS
-        elif request.find('/favicon.ico') == 6:
-            header = 'HTTP/1.1 200 OK\r\nContent-type: text/html\r\n\r\n'
-            response = "n/a"
+    async def _send_data(self, request, writer):
+        serial = request.path[6:] or None  # /data/<serial>
+        data = self.data_provider.get_data(serial)
+        if data is None:
+            await self._send_not_found(request, writer)
+            return
+        await self._send(request, writer, 'application/json', data, headers='Cache-Control: no-store\r\n')
+
+    async def _send_metrics(self, request, writer):
+        get_metrics = getattr(self.data_provider, 'get_metrics', None)
+        if get_metrics is None:
+            await self._send_not_found(request, writer)
+            return
+        await self._send(request, writer, 'application/json', get_metrics(), headers='Cache-Control: no-store\r\n')
+
+    async def _send_log(self, request, writer):
+        if log.ring is None:
+            await self._send_not_found(request, writer)
+            return
+        body = '\n'.join(log.ring).encode()
+        await self._send(request, writer, 'text/plain', body, headers='Cache-Control: no-store\r\n')
+
+    async def _send_css(self, request, writer):
+        await self._send_asset(request, writer, f'{self.static_dir}/style.css', 'text/css', _CSS)
+
+    async def _send_js(self, request, writer):
+        await self._send_asset(request, writer, f'{self.static_dir}/script.js', 'text/javascript', _JS)
+
+    async def _send_page(self, request, writer):
+        await self._send_asset(request, writer, self.start_page or f'{self.static_dir}/index.html', 'text/html', _HTML,
+                               cache='no-cache')
+
+    async def _send_not_found(self, request, writer):
+        await self._send(request, writer, 'text/html', b'', status='404 Not Found')
+
+    async def _send_events(self, request, writer):
+        """Server-sent events: push data on every change until the client disconnects"""
+        provider = self.data_provider
+        if getattr(provider, 'changed', None) is None:
+            await self._send_not_found(request, writer)
+            return
+        if self.event_clients >= self.max_event_clients:
+            await self._send(request, writer, 'text/html', b'', status='503 Service Unavailable')
+            return
+        # event streams are limited by max_event_clients, not by max_clients
+        self.event_clients += 1
+        self.clients -= 1
+        try:
+            request.keep_alive = False
+            writer.write(_encode('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-store\r\n\r\n'))
+            while True:
+                changed = provider.changed
+                writer.write(b'data: ')
+                writer.write(provider.get_data())
+                writer.write(b'\n\n')
+                await self._drain(writer)
+                while not changed.is_set():
+                    try:
+                        await asyncio.wait_for(changed.wait(), _KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        writer.write(b':\n\n')  # keepalive, detects closed connections
+                        await self._drain(writer)
+        except (OSError, asyncio.TimeoutError):
+            pass  # client disconnected or stalled
+        finally:
+            self.event_clients -= 1
+            self.clients += 1
+
+    async def _send_history(self, request, writer):
+        """History buffers as binary stream, see hoymiles.history.History"""
+        history = getattr(self.data_provider, 'history', None)
+        if history is None:
+            await self._send_not_found(request, writer)
+            return
+        header = history.header()
+        length = len(header) + 2 * history.count * len(history.keys)
+        writer.write(_encode(f'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: {length}\r\n'
+                             f'Cache-Control: no-store\r\n{self._connection(request)}\r\n'))
+        writer.write(_encode(header))
+        for chunk in history.chunks():
+            writer.write(_encode(chunk))
+            await self._drain(writer)
+
+    async def _send(self, request, writer, content_type, body, status='200 OK', headers='', length=None):
+        # length: size of a str body in bytes, without the end of the body is marked by connection close
+        if length is None and not isinstance(body, str):
+            length = len(body)
+        if status.startswith('304'):
+            headers += self._connection(request)  # no body
+        elif length is None:
+            headers += self._connection(request, length_known=False)
         else:
-            try:  # serve file
-                header = 'HTTP/1.1 200 OK\r\nContent-type: text/html\r\n\r\n'
-                if self.start_page:
-                    print('serving', self.start_page)
-                    file = open(self.start_page, "r")
-                    response = file.read()
-                    file.close()
-                else:
-                    # print('serving default request')
-                    response = _HTML
-            except Exception as e:
-                header = "HTTP/1.1 404 Not Found\n"
-                response = "<html><body><h1>File not found</h1></body></html>"
-                print(e)
-
-        writer.write(header)
-        writer.write(response)
-
-        print("elapsed time [µs]: ",  time.ticks_us() - start_time)
-        await writer.drain()
-        await writer.wait_closed()
+            headers += f'Content-Length: {length}\r\n{self._connection(request)}'
+        writer.write(_encode(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n{headers}\r\n'))
+        if body:
+            writer.write(_encode(body))
+        await self._drain(writer)
+
+    async def _send_asset(self, request, writer, path, content_type, builtin, cache=None):
+        """
+        Send static file from flash (gzip precompressed if available and accepted) or built-in
+        content, answer 304 if the browser has the current version
+        """
+        asset = self._asset(path, request.accept_gzip)
+        if asset:
+            file, gzipped, etag, size = asset
+        else:
+            builtin_info = self._etags.get(path)
+            if builtin_info is None:
+                import binascii
+                data = builtin.encode()
+                builtin_info = self._etags[path] = (f'"{binascii.crc32(data):08x}"', len(data))
+            etag, size = builtin_info
+        headers = f'Cache-Control: {cache or f"max-age={_MAX_AGE}"}\r\nETag: {etag}\r\n'
+        if asset:  # gzip negotiated
+            headers += 'Vary: Accept-Encoding\r\n'
+
+        if etag == request.if_none_match:
+            await self._send(request, writer, content_type, b'', status='304 Not Modified', headers=headers)
+        elif not asset:
+            await self._send(request, writer, content_type, builtin, headers=headers, length=size)
+        else:
+            if gzipped:
+                headers += 'Content-Encoding: gzip\r\n'
+            writer.write(_encode(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {size}\r\n'
+                                 f'{headers}{self._connection(request)}\r\n'))
+            # stream file in small chunks, never read it completely into ram
+            mv = memoryview(self._buf)
+            with open(file, 'rb') as f:
+                while True:
+                    n = f.readinto(self._buf)
+                    if not n:
+                        break
+                    writer.write(mv[:n])
+                    await self._drain(writer)
+
+    def _asset(self, path, accept_gzip):
+        # (file, gzipped, etag, size) of a static file on flash. The file found is cached and stat'ed on
+        # each request (replaced files get a new etag from size and mtime), files added later need a restart.
+        key = (path, accept_gzip)
+        asset = self._assets.get(key)
+        if asset:
+            asset = _stat_asset(asset[0], asset[1])
+            if not asset:  # removed, look up again
+                del self._assets[key]
+                return self._asset(path, accept_gzip)
+            self._assets[key] = asset
+        elif asset is None:
+            asset = False
+            for file, gzipped in ((path + '.gz', True), (path, False)):
+                if gzipped and not accept_gzip:
+                    continue
+                asset = _stat_asset(file, gzipped)
+                if asset:
+                    break
+            self._assets[key] = asset
+        return asset
 
     async def webserver(self):
-        import wlan
-
-        if self.wifi_mode == network.AP_IF:
-            wlan.start_ap(ssid='MPY-DTU')
-        elif self.wifi_mode == network.STA_IF:
-            wlan.do_connect()
+        if network is None:  # CPython
+            ip = self.host or '0.0.0.0'
         else:
-            print("no valid wifi config. skipping webserver")
-            return     # no valid wifi!
-
-        ip = network.WLAN(self.wifi_mode).ifconfig()[0]
-        port = 80
+            import wlan
+
+            if self.wifi_mode == network.AP_IF:
+                wlan.start_ap(ssid='MPY-DTU')
+            elif self.wifi_mode == network.STA_IF:
+                wlan.do_connect()
+            else:
+                print("no valid wifi config. skipping webserver")
+                return     # no valid wifi!
+
+            ip = self.host or network.WLAN(self.wifi_mode).ifconfig()[0]
+        port = self.port
         url = f'http://{ip}:{port}'
 
         self.server = await asyncio.start_server(self.serve_client, ip, port)
@@ -0,0 +1,123 @@
+"""
+Data provider of the web server hoymiles/uwebserver.py (CPython and Micropython)
+"""
+
+import asyncio
+
+TOTAL_KEYS = ('power', 'yield_today', 'yield_total')
+
+
+class WebPlugin:
+    """
+    Last data of all inverters keyed by serial, fleet totals and suntimes event.
+
+    Totals are updated incrementally with each result (the previous values of the
+    inverter are replaced). Every inverter document is serialized once per new
+    result, the fleet document is joined from the cached inverter documents.
+    """
+
+    def __init__(self, inverters=(), history=None, **params):
+        """
+        :param list inverters: inverter configs (serial, name, strings)
+        :param dict history: optional in-RAM history {'size': 1440, 'interval': 60} of the first inverter,
+                             served by /history
+        """
+        from hoymiles.jsonwriter import JsonWriter
+        self._writer = JsonWriter(1024)
+        self.inverters = {}  # serial -> last data
+        self.history = None
+        self.history_ser = None
+        for config in inverters:
+            serial = str(config.get('serial'))
+            self.inverters[serial] = {'time': None, 'inverter_ser': serial, 'inverter_name': config.get('name', 'unkown'),
+                                      'phases': [{}], 'strings': [{'name': e.get('s_name', "panel")}
+                                                                  for e in config.get('strings', [])]}
+            if history is not None and self.history is None:
+                from hoymiles.history import History
+                self.history = History(strings=max(len(config.get('strings', [])), 1),
+                                       size=history.get('size', 1440), interval=history.get('interval', 60))
+                self.history_ser = serial
+        self.totals = {'time': None, 'inverters': len(self.inverters), 'power': 0.0, 'yield_today': 0.0, 'yield_total': 0.0}
+        self.last_event = {}
+        self._values = {}  # serial -> values of TOTAL_KEYS included in totals
+        self._cache = {}   # serial -> serialized inverter data, reset by new data
+        self._json = None  # serialized fleet data, reset by new data or event
+        self.health = []   # (name, provider) of /metrics
+        self.changed = asyncio.Event()  # set (and replaced) on new data, awaited by push clients
+
+    def store_status(self, response, **params):
+        data = response.to_dict() if callable(getattr(response, 'to_dict', None)) else None
+        if not data or data.get('FW_HW_ID') or 'alarms' in data:  # no valid data, HardwareResponse or EventsResponse
+            return
+        serial = str(data.get('inverter_ser'))
+        if serial not in self.inverters:
+            self.totals['inverters'] += 1
+        self.inverters[serial] = data
+
+        values = (sum(phase.get('power') or 0 for phase in data.get('phases') or []),
+                  data.get('yield_today') or 0, data.get('yield_total') or 0)
+        previous = self._values.get(serial, (0, 0, 0))
+        for key, value, value_prev in zip(TOTAL_KEYS, values, previous):
+            self.totals[key] += value - value_prev
+        self._values[serial] = values
+        self.totals['time'] = data.get('time')
+
+        if self.history and serial == self.history_ser:
+            self.history.add(data)
+        self._cache.pop(serial, None)
+        self._changed()
+
+    def get_data(self, serial=None):
+        """
+        Data of all inverters with totals and suntimes event, or data of a single inverter, as json.
+        Documents are serialized once per new measurement.
+
+        :param str serial: inverter serial (default: all inverters)
+        :return: json or None if the inverter is unknown
+        :rtype: bytes
+        """
+        if serial is not None:
+            return self._inverter_json(serial) if serial in self.inverters else None
+        if self._json is None:
+            parts = [b'{"totals":', self._writer.dumps(self.totals), b',"event":', self._writer.dumps(self.last_event),
+                     b',"inverters":[']
+            for i, serial in enumerate(self.inverters):
+                if i:
+                    parts.append(b',')
+                parts.append(self._inverter_json(serial))
+            parts.append(b']}')
+            self._json = b''.join(parts)
+        return self._json
+
+    def _inverter_json(self, serial):
+        json = self._cache.get(serial)
+        if json is None:
+            json = self._cache[serial] = self._writer.dumps(self.inverters[serial])
+        return json
+
+    def on_event(self, event):
+        if 'suntimes' in event.get('event_type', ""):
+            self.last_event = dict(self.last_event, **event)  # keep sunrise/sunset of earlier events
+            self._changed()
+
+    def _changed(self):
+        self._json = None
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()  # wake up all waiting clients
+
+    def add_health(self, name, provider):
+        """
+        Register health counters, served as json by /metrics
+
+        :param str name: metric group name
+        :param provider: callable returning a dict (e.g. OutputDispatcher.metrics)
+        """
+        self.health.append((name, provider))
+
+    def get_metrics(self):
+        """
+        Health counters of all registered providers as json, serialized on request
+
+        :rtype: bytes
+        """
+        return self._writer.dumps({name: provider() for name, provider in self.health})
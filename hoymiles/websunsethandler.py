@@ -1,7 +1,7 @@
-import logging
 import time
 import requests
 import asyncio
+import hoymiles.log as log
 
 
 class SunsetHandler:
@@ -10,6 +10,7 @@ class SunsetHandler:
         self.suntimes_sunset = None
         self.suntimes_sunrise = None
         self.event_handler = event_handler
+        self.sleep = asyncio.sleep  # replaced by hoymiles.usleep.NightSleep
 
         if sunset_config and not sunset_config.get('disabled', False):
             # (49.453872, 11.077298)
@@ -29,7 +30,7 @@ class SunsetHandler:
                 print(f'Todays sunset is at {sunset_time} UTC, sunrise is at {sunrise_time} UTC')
                 self._send_suntimes_event('info', f'ts={time.localtime()[3:5]}', sunrise_time, sunset_time)
         else:
-            logging.info('Sunset disabled.')
+            log.info('Sunset disabled.')
 
     async def checkWaitForSunrise(self):
         if not self.suntimes_sunset or not self.suntimes_sunrise:
@@ -51,8 +52,8 @@ class SunsetHandler:
             print(f'Next sunrise is at {sunrise_time} UTC, next sunset is at {sunset_time} UTC, sleeping for {time_to_sleep} seconds.')
             print(f'Wake up in {time_to_sleep//3600:02d} hours {(time_to_sleep//60)%60:02d} min.')
             self._send_suntimes_event('sleeping', time_to_sleep, sunrise_time, sunset_time)
-            await asyncio.sleep(time_to_sleep)
-            logging.info(f'Woke up...')
+            await self.sleep(time_to_sleep)
+            log.info('Woke up...')
             self._send_suntimes_event('wakeup', time_to_sleep, sunrise_time, sunset_time)
 
     def _calc_sunrise_sunset(self, tomorrow=False):
@@ -71,7 +72,7 @@ class SunsetHandler:
             ss_h, ss_m = data.get('sunset').split(':')[:2]
             self.suntimes_sunset = int(ss_h)*60 + int(ss_m)
         except Exception as e:
-            logging.exception(e)
+            log.exception(e)
             self._send_suntimes_event('error', 'n/a', f'ts={time.localtime()[3:5]}', f'e={e}')
 
     def _send_suntimes_event(self, message, sleeping_time, sunrise_time, sunset_time):
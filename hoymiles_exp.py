@@ -2,6 +2,8 @@ from ahoy_cfg import ahoy_config
 from hoymiles import HoymilesDTU
 import asyncio
 import hoymiles.uoutputs
+import hoymiles.log as log
+from hoymiles.dispatcher import OutputDispatcher
 import gc
 
 use_wdt = True
@@ -14,6 +16,16 @@ if use_wdt:
     watchdog_timer = WDT(timeout=60000)  # 60s
     keepalive_timer = Timer(2)
 
+if ahoy_config.get('log'):
+    # optional: log level and ring buffer of the last lines (web /log)
+    log.configure(ahoy_config['log'].get('level', 'WARNING'), ring_size=ahoy_config['log'].get('ring', 0))
+
+night_sleep = None
+if ahoy_config.get('sleep'):
+    # optional: deep/light sleep until sunrise (requires sunset config)
+    from hoymiles.usleep import NightSleep
+    night_sleep = NightSleep(ahoy_config['sleep'])
+
 
 def init_network_time():
     print('init_network_time')
@@ -36,9 +48,9 @@ def init_network_time():
 
 
 def result_handler(result, inverter):
-    print(result.to_dict())
-    for output in outputs:
-        output.store_status(result)
+    if log.enabled(log.DEBUG):
+        log.debug('%s', result.to_dict())
+    dispatcher.dispatch(result, inverter)  # outputs are served by their own tasks
     # print("mem_free:", gc.mem_free())
     if use_wdt:
         watchdog_timer.feed()
@@ -62,13 +74,21 @@ def event_dispatcher(event):
 
 ip_addr = init_network_time()
 
-display = hoymiles.uoutputs.DisplayPlugin(ahoy_config.get('display', {}))  # {'i2c_num': 0}
+display = hoymiles.uoutputs.DisplayPlugin(ahoy_config.get('display', {}),  # {'i2c_num': 0}
+                                          splash=not (night_sleep and night_sleep.resumed))
 mqtt = hoymiles.uoutputs.MqttPlugin(ahoy_config.get('mqtt', {'host': 'homematic-ccu2'}), topic=ahoy_config.get('dtu', {}).get('name', 'mpy-dtu'))
 blink = hoymiles.uoutputs.BlinkPlugin(ahoy_config.get('blink', {}))  # {'led_pin': 7, 'inverted': False, 'neopixel': False}
-webdata = hoymiles.uoutputs.WebPlugin(ahoy_config.get('inverters', [{}])[0])
+webdata = hoymiles.uoutputs.WebPlugin(ahoy_config.get('inverters', []), history=ahoy_config.get('history'))
 
 outputs = [blink, display, mqtt, webdata]
 
+dispatcher = OutputDispatcher()
+dispatcher.add('blink', lambda result, inverter: blink.store_status(result), policy='latest')
+dispatcher.add('display', lambda result, inverter: display.store_status(result), policy='latest')
+dispatcher.add('mqtt', lambda result, inverter: mqtt.store_status(result), policy='fifo', size=4)
+dispatcher.add('web', lambda result, inverter: webdata.store_status(result), policy='fifo',
+               size=max(len(ahoy_config.get('inverters', [])), 1))  # keep the result of every inverter
+
 if ip_addr:
     event_dispatcher({'event_type': 'wifi.up', 'ip': ip_addr})
 
@@ -78,6 +98,10 @@ dtu = HoymilesDTU(ahoy_cfg=ahoy_config,
                   status_handler=result_handler,
                   info_handler=result_handler,
                   event_handler=event_dispatcher)
+if night_sleep:
+    night_sleep.attach(dtu, display=display, feed=watchdog_timer.feed if use_wdt else None)
+webdata.add_health('dtu', lambda: dtu.stats)
+webdata.add_health('output', dispatcher.metrics)
 # info_handler=lambda result, inverter: print("hw_info", result, result.to_dict()))
 
 
@@ -91,6 +115,7 @@ async def hoymiles_dtu():
 async def webserver():
     from hoymiles.uwebserver import WebServer
     ws = WebServer(data_provider=webdata)
+    webdata.add_health('web', ws.metrics)
     gc.collect()
     print("mem_free:", gc.mem_free())
     print("starting webserver ...")
@@ -98,6 +123,7 @@ async def webserver():
 
 
 async def main():
+    dispatcher.start()
     asyncio.create_task(hoymiles_dtu())
     asyncio.create_task(webserver())
     while True:
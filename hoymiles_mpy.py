@@ -2,6 +2,8 @@ from ahoy_cfg import ahoy_config
 from hoymiles import HoymilesDTU
 import asyncio
 import hoymiles.uoutputs
+import hoymiles.log as log
+from hoymiles.dispatcher import OutputDispatcher
 import gc
 
 use_network = True
@@ -17,6 +19,16 @@ if use_wdt:
     watchdog_timer = WDT(timeout=60000)  # 60s
     keepalive_timer = Timer(2)
 
+if ahoy_config.get('log'):
+    # optional: log level and ring buffer of the last lines (web /log)
+    log.configure(ahoy_config['log'].get('level', 'WARNING'), ring_size=ahoy_config['log'].get('ring', 0))
+
+night_sleep = None
+if ahoy_config.get('sleep'):
+    # optional: deep/light sleep until sunrise (requires sunset config)
+    from hoymiles.usleep import NightSleep
+    night_sleep = NightSleep(ahoy_config['sleep'])
+
 
 def init_network_time():
     if not use_network:
@@ -42,13 +54,9 @@ def init_network_time():
 
 
 def result_handler(result, inverter):
-    print(result.to_dict())
-    if display:
-        display.store_status(result)
-    if mqtt:
-        mqtt.store_status(result, topic=inverter.get('mqtt', {}).get('topic', None))
-    if blink:
-        blink.store_status(result)
+    if log.enabled(log.DEBUG):
+        log.debug('%s', result.to_dict())
+    dispatcher.dispatch(result, inverter)  # outputs are served by their own tasks
     # print("mem_free:", gc.mem_free())
     if use_wdt:
         watchdog_timer.feed()
@@ -80,10 +88,20 @@ def event_dispatcher(event):
 
 ip_addr = init_network_time()
 
-display = hoymiles.uoutputs.DisplayPlugin(ahoy_config.get('display', {}))  # {'i2c_num': 0}
+display = hoymiles.uoutputs.DisplayPlugin(ahoy_config.get('display', {}),  # {'i2c_num': 0}
+                                          splash=not (night_sleep and night_sleep.resumed))
 mqtt = hoymiles.uoutputs.MqttPlugin(ahoy_config.get('mqtt', {'host': 'homematic-ccu2'}))
 blink = hoymiles.uoutputs.BlinkPlugin(ahoy_config.get('blink', {}))  # {'led_pin': 7, 'inverted': False, 'neopixel': False}
 
+dispatcher = OutputDispatcher()
+if display:
+    dispatcher.add('display', lambda result, inverter: display.store_status(result), policy='latest')
+if mqtt:
+    dispatcher.add('mqtt', lambda result, inverter: mqtt.store_status(result, topic=inverter.get('mqtt', {}).get('topic', None)),
+                   policy='fifo', size=4)
+if blink:
+    dispatcher.add('blink', lambda result, inverter: blink.store_status(result), policy='latest')
+
 if ip_addr:
     event_dispatcher({'event_type': 'wifi.up', 'ip': ip_addr})
 
@@ -93,7 +111,14 @@ dtu = HoymilesDTU(ahoy_cfg=ahoy_config,
                   status_handler=result_handler,
                   info_handler=result_handler,
                   event_handler=event_dispatcher)
+if night_sleep:
+    night_sleep.attach(dtu, display=display, feed=watchdog_timer.feed if use_wdt else None)
 gc.collect()
 
-asyncio.run(dtu.start())
+
+async def main():
+    dispatcher.start()
+    await dtu.start()
+
+asyncio.run(main())
 
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Build gzip precompressed static files for hoymiles/uwebserver.py (run with CPython)
+
+Extracts the built-in page, stylesheet and script of uwebserver.py (or takes
+--page) and writes index.html.gz, style.css.gz and script.js.gz to the output
+directory. Copy the directory to the device (or add it to romfs), e.g.:
+
+    python3 make_webassets.py
+    mpremote cp -r www :
+"""
+
+import os
+import ast
+import gzip
+import argparse
+
+ASSETS = {'_HTML': 'index.html', '_CSS': 'style.css', '_JS': 'script.js'}
+
+
+def builtin_assets(source):
+    """
+    Get string constants _HTML, _CSS and _JS of uwebserver.py without importing it
+
+    :param str source: path of uwebserver.py
+    :return: file name -> content
+    :rtype: dict
+    """
+    with open(source, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    assets = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            value = node.value
+            if isinstance(value, ast.Call) and value.args:  # const("...")
+                value = value.args[0]
+            if name in ASSETS and isinstance(value, ast.Constant):
+                assets[ASSETS[name]] = value.value
+    return assets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build precompressed web assets for mpy-dtu')
+    parser.add_argument('-o', '--output', default='www', help='output directory (default: www)')
+    parser.add_argument('--source', default=os.path.join(os.path.dirname(__file__), 'hoymiles', 'uwebserver.py'),
+                        help='uwebserver.py to take the built-in assets from')
+    parser.add_argument('--page', help='custom start page (html file) instead of the built-in page')
+    args = parser.parse_args()
+
+    assets = builtin_assets(args.source)
+    if args.page:
+        with open(args.page, 'r', encoding='utf-8') as f:
+            assets['index.html'] = f.read()
+
+    os.makedirs(args.output, exist_ok=True)
+    for name, content in assets.items():
+        path = os.path.join(args.output, name + '.gz')
+        # mtime=0: identical input gives identical files (and ETag)
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(content.encode('utf-8'), compresslevel=9, mtime=0))
+        print(f'{path}: {len(content.encode("utf-8"))} -> {os.path.getsize(path)} bytes')